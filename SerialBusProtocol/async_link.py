@@ -0,0 +1,288 @@
+# Runs a WindowedProtocol on an asyncio event loop instead of polling process_rx/process_tx on a tick.
+# Received data is decoded as soon as the transport hands it over, and frames are sent when they are
+# submitted, when ACKs arrive and when a retransmit timer fires - an idle link doesn't wake up at all.
+#
+#   link = WindowedLink(id, connected_ids)
+#   await loop.create_connection(lambda: link, ...) # Or any other transport, see open_fd_link for a tty
+#   await link.send(dst, b'hello')
+#   async for frame in link.receive(src):
+#       ...
+
+import asyncio
+import os
+import random
+import traceback
+import tty
+
+from windowed_protocol import WindowedProtocol
+
+
+# WindowedProtocol clock running off the event loop's clock
+class LoopClock:
+    def __init__(self, loop):
+        self.loop = loop
+
+    def time(self):
+        return self.loop.time()
+
+# WindowedProtocol writer onto an asyncio transport, which buffers anything the device can't take yet
+class TransportWriter:
+    def __init__(self, transport):
+        self.transport = transport
+        self.max_bytes = 4096 # Most bytes to hand the transport on each flush
+
+    def write(self, data):
+        self.transport.write(bytes(data))
+
+# WindowedProtocol reader of the data the transport has passed up since the last read
+class TransportReader:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def read(self):
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        return data
+
+
+class WindowedLink(asyncio.Protocol):
+
+    # The WindowedProtocol needs the transport to write to, so it's made in connection_made with these options
+    def __init__(self, id, connected_ids, **options):
+        self.id = id
+        self.connected_ids = connected_ids
+        self.options = options
+        self.reader = TransportReader()
+        self.protocol = None
+        self.transport = None
+        self.read_transport = None # If reading has its own transport, as with pipes
+        self.loop = None
+        self.timer = None
+        self.paused = False
+        self.closed = False
+        self.initialised = asyncio.Event()
+        self.rx_ready = dict([(id, asyncio.Event()) for id in connected_ids])
+        self.tx_ready = dict([(id, asyncio.Event()) for id in connected_ids])
+
+    def connection_made(self, transport):
+        self.loop = asyncio.get_running_loop()
+        self.transport = transport
+        self.protocol = WindowedProtocol(self.id, LoopClock(self.loop), self.connected_ids, TransportWriter(transport),
+                                         self.reader, **self.options)
+        self.protocol.on_tx_space = self.__on_tx_space
+        # Anything that arrived before the transport for writing was ready
+        self.__process_rx()
+        self.__flush()
+
+    def data_received(self, data):
+        self.reader.buffer += data
+        if self.protocol != None:
+            self.__process_rx()
+            self.__flush()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+        # Wake everything waiting so it can see the link has gone
+        self.initialised.set()
+        for event in list(self.rx_ready.values()) + list(self.tx_ready.values()):
+            event.set()
+
+    # The transport's buffer is full - stop handing it frames until it has drained
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.__flush()
+
+    def close(self):
+        for transport in [self.read_transport, self.transport]:
+            if transport != None:
+                transport.close()
+
+    # Waits for the other side to accept the frame into its window. Raises ConnectionError if the link closes first
+    async def send(self, dst, frame):
+        await self.initialised.wait()
+        while not self.closed:
+            if self.protocol.submit_many(dst, [frame]) == 1:
+                self.__flush()
+                return
+            if not all(self.protocol.egress_initialised.values()):
+                # Another node has restarted. Wait for all the links to be initialised again
+                self.initialised.clear()
+                self.__flush()
+            self.tx_ready[dst].clear()
+            await self.tx_ready[dst].wait()
+        raise ConnectionError("Link closed")
+
+    # Yields the frames from src in order until the link closes
+    async def receive(self, src):
+        while True:
+            if len(self.protocol.rx_frames[src]) > 0:
+                frames = self.protocol.get_rx_frames(src)
+                # Taking the frames can free up enough room that the source needs telling
+                self.__flush()
+                for frame in frames:
+                    yield bytes(frame)
+                continue
+            if self.closed:
+                return
+            self.rx_ready[src].clear()
+            await self.rx_ready[src].wait()
+
+    def __process_rx(self):
+        self.protocol.process_rx()
+        for src in self.connected_ids:
+            if len(self.protocol.rx_frames[src]) > 0:
+                self.rx_ready[src].set()
+        # Initialised for the first time, or again after a send found a node had restarted
+        if not self.initialised.is_set() and all(self.protocol.egress_initialised.values()):
+            self.initialised.set()
+            for event in self.tx_ready.values():
+                event.set()
+
+    def __on_tx_space(self, dst):
+        self.tx_ready[dst].set()
+
+    # Send what can be sent now, then sleep until the protocol's next timer
+    def __flush(self):
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+        if self.closed or self.paused:
+            return
+        self.protocol.process_tx()
+        when = self.protocol.next_tx_time()
+        if when != None:
+            self.timer = self.loop.call_at(when, self.__flush)
+
+
+# The read and write sides of a tty are separate asyncio pipe transports, these pass both on to the link
+class _ReadSide(asyncio.Protocol):
+    def __init__(self, link):
+        self.link = link
+
+    def data_received(self, data):
+        self.link.data_received(data)
+
+    def connection_lost(self, exc):
+        self.link.connection_lost(exc)
+
+class _WriteSide(asyncio.BaseProtocol):
+    def __init__(self, link):
+        self.link = link
+
+    def connection_made(self, transport):
+        self.link.connection_made(transport)
+
+    def connection_lost(self, exc):
+        self.link.connection_lost(exc)
+
+    def pause_writing(self):
+        self.link.pause_writing()
+
+    def resume_writing(self):
+        self.link.resume_writing()
+
+# Runs a link over a tty (or pty) file descriptor, which is put in raw mode. Closing the link closes fd
+async def open_fd_link(fd, id, connected_ids, **options):
+    tty.setraw(fd)
+    loop = asyncio.get_running_loop()
+    link = WindowedLink(id, connected_ids, **options)
+    # Each transport closes its own file so the read side gets a copy of the descriptor
+    read_file = os.fdopen(os.dup(fd), 'rb', buffering=0)
+    write_file = os.fdopen(fd, 'wb', buffering=0)
+    (link.read_transport, read_protocol) = await loop.connect_read_pipe(lambda: _ReadSide(link), read_file)
+    await loop.connect_write_pipe(lambda: _WriteSide(link), write_file)
+    return link
+
+
+##########################
+# Test
+
+async def pty_loopback(num_frames, max_frame_length, options={}, close=True):
+    (controller, device) = os.openpty()
+    links = [await open_fd_link(controller, 0, [1], **options), await open_fd_link(device, 1, [0], **options)]
+    frames = [[bytes([random.randint(0,255) for i in range(random.randint(0, max_frame_length))])
+               for f in range(num_frames)] for link in links]
+
+    async def send_all(link, dst, frames):
+        for frame in frames:
+            await link.send(dst, frame)
+
+    async def receive_all(link, src, num_frames):
+        received = []
+        async for frame in link.receive(src):
+            received.append(frame)
+            if len(received) == num_frames:
+                break
+        return received
+
+    results = await asyncio.wait_for(asyncio.gather(send_all(links[0], 1, frames[0]), send_all(links[1], 0, frames[1]),
+                                                    receive_all(links[1], 0, num_frames), receive_all(links[0], 1, num_frames)), 30)
+    if close:
+        for link in links:
+            link.close()
+    return (frames, results[2:], links)
+
+def pty_loopback_test():
+    (frames, received, links) = asyncio.run(pty_loopback(500, 240))
+    assert received[0] == frames[0]
+    assert received[1] == frames[1]
+    (frames, received, links) = asyncio.run(pty_loopback(500, 16, {'selective_repeat': True, 'aggregate': True}))
+    assert received[0] == frames[0]
+    assert received[1] == frames[1]
+
+# Once everything is acked the link shouldn't have any timers running
+def idle_test():
+    async def run():
+        (frames, received, links) = await pty_loopback(20, 100, close=False)
+        # The last ACKs can still be on their way
+        for i in range(100):
+            if sum([link.protocol.num_tx_window_frames() for link in links]) == 0:
+                break
+            await asyncio.sleep(0.01)
+        idle = [link.protocol.next_tx_time() == None and link.timer == None for link in links]
+        for link in links:
+            link.close()
+        return idle
+    assert asyncio.run(run()) == [True, True]
+
+# A send waiting while a link is initialised again carries on once it is
+def reinitialise_test():
+    async def run():
+        (frames, received, links) = await pty_loopback(20, 100, close=False)
+        # As if node 1 had restarted and answered UNINITIALISED
+        links[0].protocol.egress_initialised[1] = False
+        frames = [bytes([i]) * 10 for i in range(50)]
+        async def send_all():
+            for frame in frames:
+                await links[0].send(1, frame)
+        async def receive_all():
+            received = []
+            async for frame in links[1].receive(0):
+                received.append(frame)
+                if len(received) == len(frames):
+                    return received
+        results = await asyncio.wait_for(asyncio.gather(send_all(), receive_all()), 10)
+        for link in links:
+            link.close()
+        return results[1] == frames
+    assert asyncio.run(run())
+
+
+if __name__ == "__main__":
+    tests = [pty_loopback_test, idle_test, reinitialise_test]
+    tests_passed = 0
+    for test in tests:
+        try:
+            test()
+            tests_passed += 1
+        except:
+            traceback.print_exc()
+            print(test, ": Test failed")
+            continue
+    print("{}/{} Tests succeeded".format(tests_passed, len(tests)))
@@ -0,0 +1,157 @@
+# Picks between the available implementations of the CRC and COBS code.
+# By default the fastest available implementation is used (e.g. binascii.crc_hqx for CRC16).
+# Set the environment variable SERIAL_PROTOCOL_BACKEND=python before importing, or call
+# use_pure_python(), to force the pure Python implementations. It can also be set to the name of one
+# implementation as reported by selected() (e.g. binascii), the other functions then use their fastest one.
+
+import os
+import random
+import subprocess
+import sys
+import traceback
+
+ENV_VAR = 'SERIAL_PROTOCOL_BACKEND'
+AUTO = 'auto'
+PYTHON = 'python'
+
+def requested_backend():
+    return os.environ.get(ENV_VAR, AUTO)
+
+# implementations is a list of (name, function), fastest first, and must contain a PYTHON entry
+# Returns the (name, function) to use for the backend name (or the environment variable if None).
+# Names are per function so one this function doesn't have gets the fastest implementation
+def select(implementations, name=None):
+    if name == None:
+        name = requested_backend()
+    for (impl_name, impl) in implementations:
+        if impl_name == name:
+            return (impl_name, impl)
+    return implementations[0]
+
+def use_pure_python():
+    import crc
+    import cobs
+    crc.set_backend(PYTHON)
+    cobs.set_backend(PYTHON)
+
+def use_fastest():
+    import crc
+    import cobs
+    crc.set_backend(AUTO)
+    cobs.set_backend(AUTO)
+
+# The implementation chosen for each function, e.g. {'calc16': 'binascii', ...}
+def selected():
+    import crc
+    import cobs
+    chosen = {}
+    chosen.update(crc.selected_backends)
+    chosen.update(cobs.selected_backends)
+    return chosen
+
+
+##########################
+# Conformance tests - every implementation must give identical results
+
+def random_data():
+    # cobs imports this module so it can't be imported at the top
+    from cobs import random_bytes
+    data = random_bytes(random.choice([0, 1, 2, 7, 8, 9, random.randint(0, 600)]), random.random())
+    # Every buffer type the callers use
+    return random.choice([data, bytearray(data), memoryview(data), list(data)])
+
+def crc_conformance_test():
+    import crc
+    for (name, implementations) in [('calc16', crc.CALC16_IMPLEMENTATIONS), ('crc32c', crc.CRC32C_IMPLEMENTATIONS)]:
+        for i in range(2000):
+            data = random_data()
+            value = random.randint(0, 0xffff if name == 'calc16' else 0xffffffff)
+            if name == 'calc16':
+                results = set([impl(value, data) for (impl_name, impl) in implementations])
+            else:
+                results = set([impl(data, value) for (impl_name, impl) in implementations])
+            assert len(results) == 1, (name, data, value, results)
+
+def cobs_encode_conformance_test():
+    import cobs
+    for i in range(2000):
+        data = random_data()
+        if isinstance(data, list):
+            data = bytes(data)
+        results = set([impl(data) for (impl_name, impl) in cobs.ENCODE_IMPLEMENTATIONS])
+        assert len(results) == 1, (data, results)
+
+def cobs_encode_in_place_conformance_test():
+    import cobs
+    for i in range(2000):
+        data = bytes(random_data())
+        offset = random.randint(0, 5)
+        buffer = bytearray(offset + 1) + data + bytearray(cobs.max_encoded_length(len(data)) - len(data) - 1 + 3)
+        results = set()
+        for (impl_name, impl) in cobs.ENCODE_IN_PLACE_IMPLEMENTATIONS:
+            impl_buffer = bytearray(buffer)
+            num_bytes = impl(impl_buffer, offset, len(data))
+            results.add(bytes(impl_buffer[offset:offset+num_bytes]))
+        assert len(results) == 1, (data, results)
+
+def cobs_decode_conformance_test():
+    import cobs
+    for i in range(5000):
+        # Mostly valid data but also random garbage which should be rejected the same way
+        data = bytes(random_data())
+        if random.random() < 0.5:
+            data = cobs.encode(data)
+        results = set()
+        for (impl_name, impl) in cobs.DECODE_IMPLEMENTATIONS:
+            try:
+                results.add(impl(data))
+            except cobs.DecodeError:
+                results.add(cobs.DecodeError)
+        assert len(results) == 1, (data, results)
+
+def cobs_decode_into_conformance_test():
+    import cobs
+    for i in range(5000):
+        data = bytes(random_data())
+        if random.random() < 0.5:
+            data = cobs.encode(data)
+        offset = random.randint(0, 5)
+        results = set()
+        for (impl_name, impl) in cobs.DECODE_INTO_IMPLEMENTATIONS:
+            out = bytearray(offset + len(data))
+            try:
+                num_bytes = impl(memoryview(data), out, offset)
+                results.add(bytes(out[offset:offset+num_bytes]))
+            except cobs.DecodeError:
+                results.add(cobs.DecodeError)
+        assert len(results) == 1, (data, results)
+
+def select_test():
+    implementations = [('fast', 1), (PYTHON, 2)]
+    assert select(implementations, AUTO) == ('fast', 1)
+    assert select(implementations, PYTHON) == (PYTHON, 2)
+    assert select(implementations, 'other') == ('fast', 1)
+    use_pure_python()
+    assert set(selected().values()) == set([PYTHON])
+    use_fastest()
+    # Any name selected() reports can be used for the environment variable
+    for name in set(selected().values()):
+        result = subprocess.run([sys.executable, '-c', 'import backends; print(backends.selected())'],
+                                env=dict(os.environ, **{ENV_VAR: name}), capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+        assert "'{}'".format(name) in result.stdout
+
+
+if __name__ == "__main__":
+    tests = [crc_conformance_test, cobs_encode_conformance_test, cobs_encode_in_place_conformance_test, cobs_decode_conformance_test,
+        cobs_decode_into_conformance_test, select_test]
+    tests_passed = 0
+    for test in tests:
+        try:
+            test()
+            tests_passed += 1
+        except:
+            traceback.print_exc()
+            print(test, ": Test failed")
+            continue
+    print("{}/{} Tests succeeded".format(tests_passed, len(tests)))
@@ -0,0 +1,398 @@
+# Micro benchmarks for the framing and protocol code
+# Run all of them with: python benchmarks.py
+# Or a subset by name: python benchmarks.py cobs_encode
+
+import sys
+import random
+import timeit
+import cobs
+import crc
+import windowed_protocol
+from cobs import random_bytes
+
+
+def time_per_call(func, min_time=0.2):
+    # Run the function enough times to get a stable reading, returns seconds per call
+    timer = timeit.Timer(func)
+    (number, total) = timer.autorange()
+    if total < min_time:
+        number = int(number * min_time / max(total, 1e-9)) + 1
+    best = min(timer.repeat(repeat=3, number=number))
+    return best / number
+
+##########################
+# COBS
+
+def bench_cobs_encode():
+    print("COBS encode: bytewise vs block scanning (us per call)")
+    print("{:>6} {:>8} {:>10} {:>10} {:>8}".format("bytes", "zeros", "bytewise", "block", "speedup"))
+    for length in [16, 64, 240, 1000]:
+        for zero_density in [0, 0.01, 0.1, 0.5]:
+            data = random_bytes(length, zero_density)
+            old = time_per_call(lambda: cobs._encode_bytewise(data))
+            new = time_per_call(lambda: cobs.encode(data))
+            print("{:>6} {:>8} {:>10.2f} {:>10.2f} {:>7.1f}x".format(length, zero_density, old*1e6, new*1e6, old/new))
+
+def bench_batch_encode():
+    print("Batch encoding: per frame cost as the batch grows (us per frame, 16 byte frames)")
+    print("{:>6} {:>12} {:>12} {:>14} {:>14}".format("batch", "cobs.encode", "encode_many", "encode_frame", "encode_frames"))
+    for batch_size in [1, 10, 100, 1000]:
+        frames = [random_bytes(16, 0.05) for i in range(batch_size)]
+        list_frames = [list(frame) for frame in frames]
+        single = time_per_call(lambda: [cobs.encode(frame) for frame in frames])
+        many = time_per_call(lambda: cobs.encode_many(frames))
+        frame_single = time_per_call(lambda: [windowed_protocol.encode_frame(1, 2, frame) for frame in list_frames])
+        frame_many = time_per_call(lambda: windowed_protocol.encode_frames(1, 2, list_frames))
+        print("{:>6} {:>12.2f} {:>12.2f} {:>14.2f} {:>14.2f}".format(batch_size,
+            single*1e6/batch_size, many*1e6/batch_size, frame_single*1e6/batch_size, frame_many*1e6/batch_size))
+
+##########################
+# CRC
+
+# What calc16 used to do: build the table on every call then loop a byte at a time
+def calc16_table_per_call(crc16, data):
+    lut = list(crc.LUT16)
+    for byte in data:
+        crc16 = ((crc16 << 8) & 0xff00) ^ lut[((crc16 >> 8) & 0xff) ^ byte]
+    return crc16 & 0xffff
+
+def bench_crc16():
+    print("CRC16 throughput (MB/s)")
+    print("{:>6} {:>14} {:>10} {:>10} {:>10} {:>10}".format("bytes", "table per call", "bytewise", "slice4", "slice8", "calc16"))
+    for length in [16, 64, 240, 4096]:
+        data = random_bytes(length, 0)
+        times = [time_per_call(lambda: calc16_table_per_call(0, data)),
+                 time_per_call(lambda: crc._calc16_bytewise(0, data)),
+                 time_per_call(lambda: crc.calc16_slice4(0, data)),
+                 time_per_call(lambda: crc.calc16_slice8(0, data)),
+                 time_per_call(lambda: crc.calc16(0, data))]
+        print("{:>6} {:>14.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(length, *[length / t / 1e6 for t in times]))
+    print("calc16 backend:", crc.selected_backends['calc16'])
+
+def bench_checksums():
+    print("Checksum throughput (MB/s)")
+    names = crc.checksum_names()
+    print("{:>6}".format("bytes") + "".join(["{:>10}".format(name) for name in names]))
+    for length in [4, 64, 240]:
+        data = random_bytes(length, 0)
+        times = [time_per_call(lambda: crc.get_checksum(name).calc(data)) for name in names]
+        print("{:>6}".format(length) + "".join(["{:>10.2f}".format(length / t / 1e6) for t in times]))
+    print("Wire bytes per encoded frame (and saving vs crc16)")
+    print("{:>8}".format("payload") + "".join(["{:>14}".format(name) for name in names]))
+    # 2 bytes is an ACK or INITIALISED response
+    for length in [2, 16, 240]:
+        frame = list(random_bytes(length, 0.05))
+        sizes = [len(windowed_protocol.encode_frame(1, 2, frame, crc.get_checksum(name))) for name in names]
+        base = sizes[names.index('crc16')]
+        print("{:>8}".format(length) + "".join(["{:>8} ({:+d})".format(size, base - size) for size in sizes]))
+
+##########################
+# Frames
+
+# What decode_frame used to do: list pops and conversions between lists and bytearrays
+def decode_frame_lists(rx_bytes):
+    no_result = (None, None, None)
+    if 0 not in rx_bytes:
+        return no_result
+    end = rx_bytes.index(0)
+    frame = rx_bytes[:end]
+    del rx_bytes[:end+1]
+    if len(frame) < 5:
+        return no_result
+    dst = frame.pop(0)-1
+    dst_check = frame.pop(0)-1
+    if dst != dst_check:
+        return no_result
+    try:
+        frame = list(cobs.decode(bytearray(frame)))
+    except cobs.DecodeError:
+        return no_result
+    crc_byte1 = frame.pop(-1)
+    crc_byte0 = frame.pop(-1)
+    crc16 = (crc_byte1 << 8) | crc_byte0
+    if crc16 != crc.calc16(0, frame):
+        return no_result
+    src = frame.pop(0)
+    return (src, dst, frame)
+
+def bench_decode():
+    print("Frame decode (frames/sec, stream of 100 frames)")
+    print("{:>8} {:>14} {:>14}".format("payload", "list pops", "FrameDecoder"))
+    num_frames = 100
+    for length in [16, 64, 240]:
+        stream = b''.join([windowed_protocol.encode_frame(1, 2, random_bytes(length, 0.05)) for i in range(num_frames)])
+        def decode_lists():
+            rx_bytes = list(stream)
+            while decode_frame_lists(rx_bytes)[2] != None:
+                pass
+        def decode_views():
+            for frame in windowed_protocol.FrameDecoder().feed(stream):
+                pass
+        old = time_per_call(decode_lists)
+        new = time_per_call(decode_views)
+        print("{:>8} {:>14.0f} {:>14.0f}".format(length, num_frames / old, num_frames / new))
+
+def bench_address_filter():
+    print("Receiving on a 30 node bus where 1 frame in 30 is for us (frames/sec of bus traffic, stream of 300 frames)")
+    print("{:>8} {:>14} {:>14} {:>8}".format("payload", "decode all", "filtered", "speedup"))
+    for length in [16, 64, 240]:
+        stream = b''.join([windowed_protocol.encode_frame(1, i % 30, random_bytes(length, 0.05)) for i in range(300)])
+        def decode_all():
+            for (src, dst, frame) in windowed_protocol.FrameDecoder().feed(stream):
+                if dst != 0:
+                    continue
+        def decode_filtered():
+            for frame in windowed_protocol.FrameDecoder(addresses=[0]).feed(stream):
+                pass
+        old = time_per_call(decode_all)
+        new = time_per_call(decode_filtered)
+        print("{:>8} {:>14.0f} {:>14.0f} {:>7.1f}x".format(length, 300 / old, 300 / new, old / new))
+
+##########################
+# TX window
+
+def filled_window_buffer(depth, frame_length=64):
+    # Room for one more so a frame can be added after each ack
+    size = (depth + 1) * windowed_protocol.max_frame_length(frame_length)
+    buffer = windowed_protocol.SlidingWindowByteBuffer(size, 10, 0)
+    frames = [list(random_bytes(frame_length, 0.05)) for i in range(depth)]
+    buffer.add_frames(0, 1, [i % 256 for i in range(depth)], frames)
+    return buffer
+
+def bench_window_depth():
+    print("SlidingWindowByteBuffer.get_next_frames with deep queues (us per call, 64 byte frames)")
+    print("{:>8} {:>12}".format("queued", "get frames"))
+    for depth in [10, 100, 1000, 10000]:
+        buffer = filled_window_buffer(depth)
+        per_call = time_per_call(lambda: buffer.get_next_frames(1000))
+        print("{:>8} {:>12.2f}".format(depth, per_call*1e6))
+
+def bench_ack_depth():
+    print("SlidingWindowByteBuffer.ack_frame as the queue grows (us per ack, 64 byte frames)")
+    print("{:>8} {:>12} {:>12}".format("queued", "ack head", "stale ack"))
+    for depth in [10, 100, 1000, 10000]:
+        buffer = filled_window_buffer(depth)
+        frame = list(random_bytes(64, 0.05))
+        state = {'id': depth % 256}
+        # Ack the frame at the head then queue another so the depth stays the same
+        def ack_head():
+            (id, dst, encoded) = buffer.frames[0]
+            buffer.ack_frame(dst, id)
+            buffer.add_frame(0, 1, state['id'], frame)
+            state['id'] = (state['id'] + 1) % 256
+        # An ack for something no longer queued, e.g. a repeated ack after a lost frame
+        def stale_ack():
+            buffer.ack_frame(5, 0)
+        head = time_per_call(ack_head)
+        stale = time_per_call(stale_ack)
+        print("{:>8} {:>12.2f} {:>12.2f}".format(depth, head*1e6, stale*1e6))
+
+def bench_submit():
+    print("Submitting 50 frames then acking them: bytes as lists the old way vs buffers with submit_many (us per frame)")
+    print("{:>8} {:>12} {:>12} {:>12}".format("payload", "old lists", "bytes", "memoryview"))
+    bench = windowed_protocol.TestBench()
+    bench.create_nodes(2)
+    bench.run_till_initialised(10000)
+    node = bench.nodes[0]
+    window = node.tx_windows[1]
+    for frame_length in [8, 64, 240]:
+        frames = [random_bytes(frame_length, 0.05) for i in range(50)]
+        sensor_buffer = bytearray(b"".join(frames))
+        views = [memoryview(sensor_buffer)[i*frame_length:(i+1)*frame_length] for i in range(50)]
+        # What submit_tx_frames used to do with each frame, after the caller turned its bytes into a list
+        def submit_lists():
+            for payload in frames:
+                bare_frame = list(payload)
+                frame = bare_frame.copy()
+                frame.insert(0, node.FRAME)
+                frame.append(node.tx_sequence_num[1])
+                window.add_frame(node.id, 1, node.tx_sequence_num[1], frame, node.tx_checksum[1])
+                node.tx_sequence_num[1] = (node.tx_sequence_num[1] + 1) % 256
+            window.ack_frame(1, (node.tx_sequence_num[1] - 1) % 256)
+        def submit(frames):
+            node.submit_many(1, frames)
+            window.ack_frame(1, (node.tx_sequence_num[1] - 1) % 256)
+        # Small differences so run for longer than usual
+        old = time_per_call(submit_lists, 1)
+        new = time_per_call(lambda: submit(frames), 1)
+        view = time_per_call(lambda: submit(views), 1)
+        print("{:>8} {:>12.2f} {:>12.2f} {:>12.2f}".format(frame_length, old*1e6/50, new*1e6/50, view*1e6/50))
+
+##########################
+# Protocol
+
+# Payload bytes per second of simulated time delivered between every pair of nodes
+# Also returns the bench so the nodes can be looked at afterwards
+def goodput(num_nodes, disconnected=[], ticks=5000, frame_length=100, selective_repeat=False, corruption_rate=None,
+            ticks_betwen_processes=None, fixed_rto=False, num_batches=20, window_frames=None):
+    bench = windowed_protocol.TestBench()
+    if ticks_betwen_processes != None:
+        bench.ticks_betwen_processes = ticks_betwen_processes
+    bench.create_nodes(num_nodes, selective_repeat=selective_repeat)
+    if fixed_rto:
+        # Always wait the initial timeout, as the protocol used to
+        for node in bench.nodes:
+            node.MIN_RTO = node.MAX_RTO = node.INITIAL_RTO
+    if window_frames != None:
+        # Only limit the number of frames in flight, as the protocol used to
+        for node in bench.nodes:
+            node.WINDOW_BYTES = 0xffff
+            for window in node.tx_windows.values():
+                window.window_size = window_frames
+                window.window_bytes = None
+    bench.run_till_initialised(100 * bench.ticks_betwen_processes)
+    if corruption_rate != None:
+        for node in bench.nodes:
+            node.writer.corruption_rate = corruption_rate
+    for id in disconnected:
+        bench.disconnect(id)
+    # Submit in small batches to each destination in turn like an application would
+    for batch in range(num_batches):
+        for tx in range(num_nodes):
+            for rx in range(num_nodes):
+                if rx != tx:
+                    frames = [list(random_bytes(frame_length, 0.05)) for i in range(10)]
+                    bench.nodes[tx].submit_tx_frames(rx, frames)
+    bench.run_for(ticks)
+    return (bench.rx_bytes() * bench.ticks_per_sec / ticks, bench)
+
+def bench_goodput():
+    print("Aggregate goodput in the TestBench (kB/s of payload, 100 byte frames)")
+    print("{:>6} {:>14} {:>14}".format("nodes", "all connected", "one dead"))
+    for num_nodes in [2, 3, 5]:
+        (connected, bench) = goodput(num_nodes)
+        (dead, bench) = goodput(num_nodes, [num_nodes - 1])
+        print("{:>6} {:>14.1f} {:>14.1f}".format(num_nodes, connected / 1000, dead / 1000))
+
+def bench_selective_repeat():
+    print("Go-back-N vs selective repeat goodput as the TestWriter corrupts more writes (kB/s of payload, 3 nodes)")
+    print("{:>10} {:>12} {:>12} {:>8}".format("corrupted", "go-back-N", "selective", "gain"))
+    for corruption_rate in [0, 1/20, 1/5, 1/2]:
+        (go_back_n, bench) = goodput(3, corruption_rate=corruption_rate)
+        (selective, bench) = goodput(3, selective_repeat=True, corruption_rate=corruption_rate)
+        print("{:>10.2f} {:>12.1f} {:>12.1f} {:>7.2f}x".format(corruption_rate, go_back_n / 1000, selective / 1000, selective / go_back_n))
+
+# Which writes get corrupted varies a lot from run to run, and each loss costs a whole window with go-back-N,
+# so both timeouts are run with the same seeds and averaged
+def bench_rto(num_runs=10):
+    print("Fixed 1ms retransmit timeout vs adaptive timeout as the nodes take longer to respond "
+          "(2 nodes, mean of {} runs)".format(num_runs))
+    print("{:>12} {:>24} {:>24}".format("process gap", "fixed kB/s (resent)", "adaptive kB/s (resent)"))
+    for ticks_betwen_processes in [100, 500, 2000]:
+        results = []
+        for fixed_rto in [True, False]:
+            total_rate = 0
+            total_resent = 0
+            for run in range(num_runs):
+                random.seed(run)
+                (rate, bench) = goodput(2, ticks=40 * ticks_betwen_processes, ticks_betwen_processes=ticks_betwen_processes,
+                                        fixed_rto=fixed_rto, num_batches=80)
+                total_rate += rate
+                total_resent += sum([window.num_retransmissions for node in bench.nodes for window in node.tx_windows.values()])
+            results.append("{:>16.1f} ({:>5.1f})".format(total_rate / num_runs / 1000, total_resent / num_runs))
+        print("{:>10}us {:>24} {:>24}".format(ticks_betwen_processes, *results))
+    random.seed()
+
+def bench_window():
+    print("Window of 10 frames vs {} bytes as the frames get bigger (kB/s of payload, 2 nodes)".format(
+        windowed_protocol.WindowedProtocol.WINDOW_BYTES))
+    print("{:>8} {:>12} {:>12}".format("payload", "10 frames", "bytes"))
+    for frame_length in [4, 16, 64, 240]:
+        # Queue as much as fits in the TX buffer
+        num_batches = windowed_protocol.WindowedProtocol.TX_WINDOW_BUFFER_SIZE // (10 * (frame_length + 16))
+        (frames, bench) = goodput(2, ticks=5000, frame_length=frame_length, num_batches=num_batches, window_frames=10)
+        (window_bytes, bench) = goodput(2, ticks=5000, frame_length=frame_length, num_batches=num_batches)
+        print("{:>8} {:>12.1f} {:>12.1f}".format(frame_length, frames / 1000, window_bytes / 1000))
+
+def bench_acks():
+    print("Bus airtime to send 200 frames between every pair of 3 nodes as ACKs are coalesced")
+    print("{:>8} {:>10} {:>8} {:>12} {:>12} {:>10}".format("payload", "ack delay", "acks", "wire bytes", "per payload", "time (ms)"))
+    for frame_length in [8, 100]:
+        for ack_delay in [None, 0, 0.0002]:
+            bench = windowed_protocol.TestBench()
+            bench.create_nodes(3)
+            for node in bench.nodes:
+                node.ACK_DELAY = ack_delay
+            bench.run_till_initialised(10000)
+            start_bytes = sum([node.writer.num_bytes for node in bench.nodes])
+            start_time = bench.clock.time()
+            for tx in range(3):
+                for rx in range(3):
+                    if rx != tx:
+                        bench.nodes[tx].submit_tx_frames(rx, [list(random_bytes(frame_length, 0.05)) for i in range(200)])
+            assert bench.run(6 * 200, 10000000)
+            wire_bytes = sum([node.writer.num_bytes for node in bench.nodes]) - start_bytes
+            acks = sum([node.num_acks_sent for node in bench.nodes])
+            print("{:>8} {:>10} {:>8} {:>12} {:>12.2f} {:>10.2f}".format(frame_length, str(ack_delay), acks, wire_bytes,
+                wire_bytes / bench.rx_bytes(), (bench.clock.time() - start_time) * 1000))
+
+def bench_aggregate():
+    print("Telemetry between 3 nodes: each node submits 4 messages to each other node every 100us, one at a time")
+    print("{:>8} {:>24} {:>24}".format("payload", "single: wire bytes/payload", "aggregated: wire/payload"))
+    for frame_length in [4, 8, 16, 64]:
+        results = []
+        for aggregate in [False, True]:
+            bench = windowed_protocol.TestBench()
+            bench.create_nodes(3, aggregate=aggregate)
+            bench.run_till_initialised(10000)
+            start_bytes = sum([node.writer.num_bytes for node in bench.nodes])
+            num_frames = 0
+            for period in range(50):
+                for tx in range(3):
+                    for rx in range(3):
+                        if rx != tx:
+                            for i in range(4):
+                                num_frames += bench.nodes[tx].submit_tx_frames(rx, [list(random_bytes(frame_length, 0.05))])
+                bench.run_for(bench.ticks_betwen_processes)
+            assert bench.run(num_frames, 10000000)
+            wire_bytes = sum([node.writer.num_bytes for node in bench.nodes]) - start_bytes
+            results.append(wire_bytes / bench.rx_bytes())
+        print("{:>8} {:>24.2f} {:>24.2f}".format(frame_length, *results))
+
+def bench_sequence_bytes():
+    print("1 vs 2 byte sequence numbers on links with 1ms round trips (kB/s of payload, 2 nodes, 16 byte frames)")
+    print("{:>12} {:>12} {:>12}".format("link kB/s", "1 byte", "2 bytes"))
+    for max_bytes in [2000, 10000, 50000]:
+        results = []
+        for sequence_bytes in [1, 2]:
+            bench = windowed_protocol.TestBench()
+            bench.ticks_betwen_processes = 1000
+            bench.create_nodes(2, sequence_bytes=[sequence_bytes], selective_repeat=True)
+            for node in bench.nodes:
+                node.WINDOW_SIZE = node.RX_QUEUE_FRAMES = 2000
+                node.WINDOW_BYTES = node.RX_BUFFER_SIZE = 60000
+                node.writer.max_bytes = max_bytes
+                node.writer.corruption_rate = 1/100
+            bench.run_till_initialised(100 * bench.ticks_betwen_processes)
+            num_frames = bench.nodes[0].submit_tx_frames(1, [list(random_bytes(16, 0.05)) for i in range(3000)])
+            start_time = bench.clock.time()
+            assert bench.run(num_frames, 10000000)
+            results.append(bench.rx_bytes() / (bench.clock.time() - start_time))
+        link_rate = max_bytes * bench.ticks_per_sec / bench.ticks_betwen_processes
+        print("{:>12.0f} {:>12.1f} {:>12.1f}".format(link_rate / 1000, results[0] / 1000, results[1] / 1000))
+
+
+BENCHMARKS = {
+    "cobs_encode": bench_cobs_encode,
+    "batch_encode": bench_batch_encode,
+    "crc16": bench_crc16,
+    "checksums": bench_checksums,
+    "decode": bench_decode,
+    "address_filter": bench_address_filter,
+    "window_depth": bench_window_depth,
+    "ack_depth": bench_ack_depth,
+    "submit": bench_submit,
+    "goodput": bench_goodput,
+    "selective_repeat": bench_selective_repeat,
+    "rto": bench_rto,
+    "window": bench_window,
+    "acks": bench_acks,
+    "aggregate": bench_aggregate,
+    "sequence_bytes": bench_sequence_bytes,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
+        print()
@@ -6,6 +6,8 @@ Taken from https://raw.githubusercontent.com/cmcqueen/cobs-python/main/python3/c
 This version is for Python 3.x.
 """
 
+import backends
+
 
 class DecodeError(Exception):
     pass
@@ -30,6 +32,50 @@ def encode(in_bytes):
     string will be expanded slightly, by a predictable amount.
     
     An empty string is encoded to '\\x01'"""
+    return _encode(in_bytes)
+
+
+def _encode_split(in_bytes):
+    if isinstance(in_bytes, str):
+        raise TypeError('Unicode-objects must be encoded as bytes first')
+    in_bytes_mv = _get_buffer_view(in_bytes)
+    # Let split() find the zeros in one pass so we only loop once per block rather than once per byte
+    if isinstance(in_bytes, (bytes, bytearray)):
+        blocks = in_bytes.split(b'\x00')
+    else:
+        blocks = in_bytes_mv.tobytes().split(b'\x00')
+    out_bytes = bytearray()
+    _append_encoded_blocks(blocks, out_bytes)
+    return bytes(out_bytes)
+
+
+def _append_encoded_blocks(blocks, out_bytes):
+    # blocks is the input split on zero bytes
+    last_idx = len(blocks) - 1
+    for block_idx, block in enumerate(blocks):
+        length = len(block)
+        if length < 0xFE:
+            out_bytes.append(length + 1)
+            out_bytes += block
+        else:
+            # Runs of more than 253 non-zero bytes are split into 0xFF blocks which have no implied zero
+            block_mv = memoryview(block)
+            start = 0
+            while length - start >= 0xFE:
+                out_bytes.append(0xFF)
+                out_bytes += block_mv[start:start+0xFE]
+                start += 0xFE
+            # If the data finished exactly on a full block there is nothing left to add
+            if block_idx == last_idx and start == length:
+                break
+            out_bytes.append(length - start + 1)
+            out_bytes += block_mv[start:]
+
+
+def _encode_bytewise(in_bytes):
+    """Reference COBS encoder that walks the input one byte at a time.
+    
+    This is the pure Python backend for encode()."""
     if isinstance(in_bytes, str):
         raise TypeError('Unicode-objects must be encoded as bytes first')
     in_bytes_mv = _get_buffer_view(in_bytes)
@@ -64,6 +110,20 @@ def decode(in_bytes):
     
     A cobs.DecodeError exception will be raised if the encoded data
     is invalid."""
+    return _decode(in_bytes)
+
+
+def _decode_scan(in_bytes):
+    # Scans for invalid zeros in one go then copies a block at a time
+    if isinstance(in_bytes, str):
+        raise TypeError('Unicode-objects are not supported; byte buffer objects only')
+    out_bytes = bytearray(len(_get_buffer_view(in_bytes)))
+    length = _decode_into_scan(in_bytes, out_bytes)
+    del out_bytes[length:]
+    return bytes(out_bytes)
+
+
+def _decode_python(in_bytes):
     if isinstance(in_bytes, str):
         raise TypeError('Unicode-objects are not supported; byte buffer objects only')
     in_bytes_mv = _get_buffer_view(in_bytes)
@@ -95,6 +155,213 @@ def decode(in_bytes):
 
 
 
+def max_encoded_length(length):
+    """Return the largest number of bytes that encoding length bytes can produce.
+    
+    This is the space encode_into() needs to be able to write into."""
+    return length + max(1, (length + 0xFD) // 0xFE)
+
+
+def _get_writable_view(out_buffer):
+    mv = memoryview(out_buffer)
+    if mv.readonly:
+        raise TypeError('output buffer must be writable')
+    if mv.ndim > 1 or mv.itemsize > 1:
+        raise BufferError('object must be a single-dimension buffer of bytes.')
+    return mv.cast('B')
+
+
+def encode_into(in_bytes, out_buffer, offset=0):
+    """Encode a string using Consistent Overhead Byte Stuffing (COBS)
+    straight into a writable buffer owned by the caller, starting at offset.
+    
+    The buffer must have at least max_encoded_length(len(in_bytes)) bytes
+    free from offset. Returns the number of bytes written."""
+    if isinstance(in_bytes, str):
+        raise TypeError('Unicode-objects must be encoded as bytes first')
+    in_bytes_mv = _get_buffer_view(in_bytes)
+    out_mv = _get_writable_view(out_buffer)
+    if offset + max_encoded_length(len(in_bytes_mv)) > len(out_mv):
+        raise ValueError('not enough space in the output buffer')
+    if isinstance(in_bytes, (bytes, bytearray)):
+        blocks = in_bytes.split(b'\x00')
+    else:
+        blocks = in_bytes_mv.tobytes().split(b'\x00')
+    last_idx = len(blocks) - 1
+    pos = offset
+    for block_idx, block in enumerate(blocks):
+        length = len(block)
+        if length < 0xFE:
+            out_mv[pos] = length + 1
+            out_mv[pos+1:pos+1+length] = block
+            pos += length + 1
+        else:
+            block_mv = memoryview(block)
+            start = 0
+            while length - start >= 0xFE:
+                out_mv[pos] = 0xFF
+                out_mv[pos+1:pos+0xFF] = block_mv[start:start+0xFE]
+                pos += 0xFF
+                start += 0xFE
+            if block_idx == last_idx and start == length:
+                break
+            out_mv[pos] = length - start + 1
+            out_mv[pos+1:pos+1+length-start] = block_mv[start:]
+            pos += length - start + 1
+    return pos - offset
+
+
+def encode_in_place(buffer, offset, length):
+    """Encode using Consistent Overhead Byte Stuffing (COBS) without
+    copying the data anywhere else first.
+    
+    The length bytes to encode must already be in the bytearray at
+    buffer[offset+1:offset+1+length], leaving buffer[offset] free for the
+    first length code. The buffer must have max_encoded_length(length)
+    bytes from offset.
+    
+    Returns the number of encoded bytes written from offset."""
+    return _encode_in_place(buffer, offset, length)
+
+
+def _encode_in_place_find(buffer, offset, length):
+    # Each zero is overwritten with a length code. Only runs of more than 253 non-zero bytes need the
+    # rest of the data moved along to make room for an extra code
+    if offset + max_encoded_length(length) > len(buffer):
+        raise ValueError('not enough space in the buffer')
+    code_pos = offset
+    start = offset + 1
+    end = offset + 1 + length
+    while True:
+        zero_idx = buffer.find(0, start, end)
+        block_end = end if zero_idx < 0 else zero_idx
+        while block_end - start >= 0xFE:
+            buffer[code_pos] = 0xFF
+            if zero_idx < 0 and block_end - start == 0xFE:
+                # The data finished exactly on a full block so there is nothing left to add
+                return end - offset
+            # Move the rest of the data up one to make room for the next code
+            code_pos = start + 0xFE
+            buffer[code_pos+1:end+1] = buffer[code_pos:end]
+            start = code_pos + 1
+            end += 1
+            block_end += 1
+            if zero_idx >= 0:
+                zero_idx += 1
+        buffer[code_pos] = block_end - start + 1
+        if zero_idx < 0:
+            return end - offset
+        code_pos = zero_idx
+        start = zero_idx + 1
+
+
+def _encode_in_place_python(buffer, offset, length):
+    # Reference version - encodes a copy with the bytewise encoder and writes it back
+    if offset + max_encoded_length(length) > len(buffer):
+        raise ValueError('not enough space in the buffer')
+    encoded = _encode_bytewise(buffer[offset+1:offset+1+length])
+    buffer[offset:offset+len(encoded)] = encoded
+    return len(encoded)
+
+
+def encode_many(frames):
+    """Encode a list of byte strings using Consistent Overhead Byte
+    Stuffing (COBS) into one joined buffer.
+    
+    Returns (encoded, offsets) where encoded is a bytearray and frame i
+    is encoded[offsets[i]:offsets[i+1]]."""
+    out_bytes = bytearray()
+    offsets = [0]
+    for frame in frames:
+        if isinstance(frame, str):
+            raise TypeError('Unicode-objects must be encoded as bytes first')
+        if not isinstance(frame, (bytes, bytearray)):
+            frame = _get_buffer_view(frame).tobytes()
+        _append_encoded_blocks(frame.split(b'\x00'), out_bytes)
+        offsets.append(len(out_bytes))
+    return (out_bytes, offsets)
+
+
+def decode_into(in_bytes, out_buffer, offset=0):
+    """Decode a string using Consistent Overhead Byte Stuffing (COBS)
+    straight into a writable buffer owned by the caller, starting at offset.
+    
+    The decoded data is always shorter than the encoded data so the buffer
+    needs len(in_bytes) bytes free from offset. Returns the number of bytes
+    written.
+    
+    A cobs.DecodeError exception will be raised if the encoded data
+    is invalid."""
+    return _decode_into(in_bytes, out_buffer, offset)
+
+
+def _decode_into_scan(in_bytes, out_buffer, offset=0):
+    if isinstance(in_bytes, str):
+        raise TypeError('Unicode-objects are not supported; byte buffer objects only')
+    in_bytes_mv = _get_buffer_view(in_bytes).cast('B')
+    out_mv = _get_writable_view(out_buffer)
+    in_length = len(in_bytes_mv)
+    if offset + in_length > len(out_mv):
+        raise ValueError('not enough space in the output buffer')
+    # Valid encoded data never contains a zero so check it all at once rather than per block
+    if isinstance(in_bytes, (bytes, bytearray)):
+        has_zero = in_bytes.find(0) >= 0
+    else:
+        has_zero = in_bytes_mv.tobytes().find(0) >= 0
+    if has_zero:
+        raise DecodeError("zero byte found in input")
+    pos = offset
+    idx = 0
+    while idx < in_length:
+        length = in_bytes_mv[idx]
+        idx += 1
+        end = idx + length - 1
+        if end > in_length:
+            raise DecodeError("not enough input bytes for length code")
+        out_mv[pos:pos+length-1] = in_bytes_mv[idx:end]
+        pos += length - 1
+        idx = end
+        if idx < in_length and length < 0xFF:
+            out_mv[pos] = 0
+            pos += 1
+    return pos - offset
+
+
+def _decode_into_python(in_bytes, out_buffer, offset=0):
+    # Reference version - decodes with the bytewise decoder and copies the result in
+    if isinstance(in_bytes, str):
+        raise TypeError('Unicode-objects are not supported; byte buffer objects only')
+    out_mv = _get_writable_view(out_buffer)
+    if offset + len(_get_buffer_view(in_bytes)) > len(out_mv):
+        raise ValueError('not enough space in the output buffer')
+    decoded = _decode_python(in_bytes)
+    out_mv[offset:offset+len(decoded)] = decoded
+    return len(decoded)
+
+
+
+##########################
+# Backends - fastest first, see backends.py
+
+ENCODE_IMPLEMENTATIONS = [('split', _encode_split), (backends.PYTHON, _encode_bytewise)]
+DECODE_IMPLEMENTATIONS = [('scan', _decode_scan), (backends.PYTHON, _decode_python)]
+ENCODE_IN_PLACE_IMPLEMENTATIONS = [('find', _encode_in_place_find), (backends.PYTHON, _encode_in_place_python)]
+DECODE_INTO_IMPLEMENTATIONS = [('scan', _decode_into_scan), (backends.PYTHON, _decode_into_python)]
+
+selected_backends = {}
+
+# name is backends.AUTO, backends.PYTHON, an implementation name or None to use the SERIAL_PROTOCOL_BACKEND
+# environment variable
+def set_backend(name=None):
+    global _encode, _decode, _encode_in_place, _decode_into
+    (selected_backends['cobs.encode'], _encode) = backends.select(ENCODE_IMPLEMENTATIONS, name)
+    (selected_backends['cobs.decode'], _decode) = backends.select(DECODE_IMPLEMENTATIONS, name)
+    (selected_backends['cobs.encode_in_place'], _encode_in_place) = backends.select(ENCODE_IN_PLACE_IMPLEMENTATIONS, name)
+    (selected_backends['cobs.decode_into'], _decode_into) = backends.select(DECODE_INTO_IMPLEMENTATIONS, name)
+
+set_backend()
+
+
 
 
 
@@ -184,11 +451,96 @@ def decode(in_bytes):
 #     print("{}/{} Tests succeeded".format(tests_passed, len(tests)))
 
 
+##########################
+# Test
 
+import random
+import traceback
 
+def random_bytes(length, zero_density):
+    return bytes([0 if random.random() < zero_density else random.randint(1, 255) for i in range(length)])
 
+def basic_test():
+    for length in [0, 1, 2, 253, 254, 255, 507, 508, 509, 1000]:
+        for zero_density in [0, 0.01, 0.1, 0.5, 1]:
+            data = random_bytes(length, zero_density)
+            encoded = encode(data)
+            assert encoded == _encode_bytewise(data)
+            assert 0 not in encoded
+            assert decode(encoded) == data
+
+def input_types_test():
+    data = random_bytes(300, 0.1)
+    exp = _encode_bytewise(data)
+    assert encode(bytearray(data)) == exp
+    assert encode(memoryview(data)) == exp
+    assert encode(memoryview(data)[10:]) == _encode_bytewise(data[10:])
+
+def random_test():
+    for i in range(2000):
+        data = random_bytes(random.randint(0, 600), random.random())
+        assert encode(data) == _encode_bytewise(data)
+
+def encode_into_test():
+    for i in range(1000):
+        data = random_bytes(random.randint(0, 600), random.random())
+        exp = encode(data)
+        assert len(exp) <= max_encoded_length(len(data))
+        offset = random.randint(0, 10)
+        out = bytearray(offset + max_encoded_length(len(data)))
+        num_bytes = encode_into(data, out, offset)
+        assert out[offset:offset+num_bytes] == exp
+        assert out[:offset] == bytearray(offset)
+
+def decode_into_test():
+    for i in range(1000):
+        data = random_bytes(random.randint(0, 600), random.random())
+        encoded = encode(data)
+        offset = random.randint(0, 10)
+        out = bytearray(offset + len(encoded))
+        num_bytes = decode_into(memoryview(encoded), out, offset)
+        assert out[offset:offset+num_bytes] == data
+    # Invalid data
+    for encoded in [b'\x00', b'\x03\x01', b'\x02\x00\x01', b'\x05\x01\x01']:
+        try:
+            decode_into(encoded, bytearray(10))
+            assert 0
+        except DecodeError:
+            pass
+
+def max_encoded_length_test():
+    for length in [0, 1, 253, 254, 255, 508, 509, 1000]:
+        assert max_encoded_length(length) == len(encode(bytes([1] * length)))
+
+def encode_many_test():
+    for num_frames in [0, 1, 2, 100]:
+        frames = [random_bytes(random.randint(0, 300), random.random()) for i in range(num_frames)]
+        (encoded, offsets) = encode_many(frames)
+        assert len(offsets) == num_frames + 1
+        assert encoded == b''.join([encode(frame) for frame in frames])
+        for i in range(num_frames):
+            assert decode(encoded[offsets[i]:offsets[i+1]]) == frames[i]
+
+def encode_in_place_test():
+    for length in list(range(0, 10)) + [253, 254, 255, 507, 508, 509, 1000]:
+        for zero_density in [0, 0.01, 0.1, 0.5, 1]:
+            data = random_bytes(length, zero_density)
+            exp = encode(data)
+            offset = random.randint(0, 5)
+            buffer = bytearray(offset + 1) + data + bytearray(max_encoded_length(length) - length - 1 + 3)
+            num_bytes = encode_in_place(buffer, offset, length)
+            assert buffer[offset:offset+num_bytes] == exp, (length, zero_density)
 
-        
-        
-        
 
+if __name__ == "__main__":
+    tests = [basic_test, input_types_test, random_test, encode_into_test, decode_into_test, max_encoded_length_test, encode_many_test, encode_in_place_test]
+    tests_passed = 0
+    for test in tests:
+        try:
+            test()
+            tests_passed += 1
+        except:
+            traceback.print_exc()
+            print(test, ": Test failed")
+            continue
+    print("{}/{} Tests succeeded".format(tests_passed, len(tests)))
@@ -1,40 +1,351 @@
+# CRC-16/XMODEM (CCITT polynomial 0x1021, MSB first)
+# The tables are built once at import rather than on every call
+# calc16 uses the fastest implementation available, see backends.py
 
+import backends
+try:
+    import binascii
+except ImportError:
+    binascii = None
+try:
+    import crc32c as _crc32c_ext # Optional C implementation of CRC-32C
+except ImportError:
+    _crc32c_ext = None
+
+LUT16 = [
+    0x0000, 0x1021, 0x2042, 0x3063, 0x4084, 0x50A5, 0x60C6, 0x70E7,
+    0x8108, 0x9129, 0xA14A, 0xB16B, 0xC18C, 0xD1AD, 0xE1CE, 0xF1EF,
+    0x1231, 0x0210, 0x3273, 0x2252, 0x52B5, 0x4294, 0x72F7, 0x62D6,
+    0x9339, 0x8318, 0xB37B, 0xA35A, 0xD3BD, 0xC39C, 0xF3FF, 0xE3DE,
+    0x2462, 0x3443, 0x0420, 0x1401, 0x64E6, 0x74C7, 0x44A4, 0x5485,
+    0xA56A, 0xB54B, 0x8528, 0x9509, 0xE5EE, 0xF5CF, 0xC5AC, 0xD58D,
+    0x3653, 0x2672, 0x1611, 0x0630, 0x76D7, 0x66F6, 0x5695, 0x46B4,
+    0xB75B, 0xA77A, 0x9719, 0x8738, 0xF7DF, 0xE7FE, 0xD79D, 0xC7BC,
+    0x48C4, 0x58E5, 0x6886, 0x78A7, 0x0840, 0x1861, 0x2802, 0x3823,
+    0xC9CC, 0xD9ED, 0xE98E, 0xF9AF, 0x8948, 0x9969, 0xA90A, 0xB92B,
+    0x5AF5, 0x4AD4, 0x7AB7, 0x6A96, 0x1A71, 0x0A50, 0x3A33, 0x2A12,
+    0xDBFD, 0xCBDC, 0xFBBF, 0xEB9E, 0x9B79, 0x8B58, 0xBB3B, 0xAB1A,
+    0x6CA6, 0x7C87, 0x4CE4, 0x5CC5, 0x2C22, 0x3C03, 0x0C60, 0x1C41,
+    0xEDAE, 0xFD8F, 0xCDEC, 0xDDCD, 0xAD2A, 0xBD0B, 0x8D68, 0x9D49,
+    0x7E97, 0x6EB6, 0x5ED5, 0x4EF4, 0x3E13, 0x2E32, 0x1E51, 0x0E70,
+    0xFF9F, 0xEFBE, 0xDFDD, 0xCFFC, 0xBF1B, 0xAF3A, 0x9F59, 0x8F78,
+    0x9188, 0x81A9, 0xB1CA, 0xA1EB, 0xD10C, 0xC12D, 0xF14E, 0xE16F,
+    0x1080, 0x00A1, 0x30C2, 0x20E3, 0x5004, 0x4025, 0x7046, 0x6067,
+    0x83B9, 0x9398, 0xA3FB, 0xB3DA, 0xC33D, 0xD31C, 0xE37F, 0xF35E,
+    0x02B1, 0x1290, 0x22F3, 0x32D2, 0x4235, 0x5214, 0x6277, 0x7256,
+    0xB5EA, 0xA5CB, 0x95A8, 0x8589, 0xF56E, 0xE54F, 0xD52C, 0xC50D,
+    0x34E2, 0x24C3, 0x14A0, 0x0481, 0x7466, 0x6447, 0x5424, 0x4405,
+    0xA7DB, 0xB7FA, 0x8799, 0x97B8, 0xE75F, 0xF77E, 0xC71D, 0xD73C,
+    0x26D3, 0x36F2, 0x0691, 0x16B0, 0x6657, 0x7676, 0x4615, 0x5634,
+    0xD94C, 0xC96D, 0xF90E, 0xE92F, 0x99C8, 0x89E9, 0xB98A, 0xA9AB,
+    0x5844, 0x4865, 0x7806, 0x6827, 0x18C0, 0x08E1, 0x3882, 0x28A3,
+    0xCB7D, 0xDB5C, 0xEB3F, 0xFB1E, 0x8BF9, 0x9BD8, 0xABBB, 0xBB9A,
+    0x4A75, 0x5A54, 0x6A37, 0x7A16, 0x0AF1, 0x1AD0, 0x2AB3, 0x3A92,
+    0xFD2E, 0xED0F, 0xDD6C, 0xCD4D, 0xBDAA, 0xAD8B, 0x9DE8, 0x8DC9,
+    0x7C26, 0x6C07, 0x5C64, 0x4C45, 0x3CA2, 0x2C83, 0x1CE0, 0x0CC1,
+    0xEF1F, 0xFF3E, 0xCF5D, 0xDF7C, 0xAF9B, 0xBFBA, 0x8FD9, 0x9FF8,
+    0x6E17, 0x7E36, 0x4E55, 0x5E74, 0x2E93, 0x3EB2, 0x0ED1, 0x1EF0
+]
+
+# Slicing tables: LUT16_SLICES[k][byte] is the CRC of byte followed by k zero bytes
+# This lets several bytes be folded into the CRC per loop iteration
+def _build_slice_tables(lut, num_slices):
+    tables = [lut]
+    for k in range(1, num_slices):
+        prev = tables[-1]
+        tables.append([((value << 8) & 0xff00) ^ lut[(value >> 8) & 0xff] for value in prev])
+    return tables
+
+LUT16_SLICES = _build_slice_tables(LUT16, 8)
+
+
+def _calc16_bytewise(crc, data):
+    for byte in data:
+        crc = ((crc << 8) & 0xff00) ^ LUT16[((crc >> 8) & 0xff) ^ byte]
+    return crc & 0xffff
+
+# Slicing-by-4, same result as calc16
+def calc16_slice4(crc, data):
+    crc &= 0xffff
+    (t0, t1, t2, t3) = LUT16_SLICES[:4]
+    end = len(data) - len(data) % 4
+    it = iter(data[:end])
+    for (b0, b1, b2, b3) in zip(it, it, it, it):
+        crc = t3[(crc >> 8) ^ b0] ^ t2[(crc & 0xff) ^ b1] ^ t1[b2] ^ t0[b3]
+    return _calc16_bytewise(crc, data[end:])
+
+# Slicing-by-8, same result as calc16
+def calc16_slice8(crc, data):
+    # Not worth setting up the slicing for very short data like ACK frames
+    if len(data) < 8:
+        return _calc16_bytewise(crc & 0xffff, data)
+    crc &= 0xffff
+    (t0, t1, t2, t3, t4, t5, t6, t7) = LUT16_SLICES
+    end = len(data) - len(data) % 8
+    it = iter(data[:end])
+    for (b0, b1, b2, b3, b4, b5, b6, b7) in zip(it, it, it, it, it, it, it, it):
+        crc = (t7[(crc >> 8) ^ b0] ^ t6[(crc & 0xff) ^ b1] ^ t5[b2] ^ t4[b3] ^
+               t3[b4] ^ t2[b5] ^ t1[b6] ^ t0[b7])
+    return _calc16_bytewise(crc, data[end:])
+
+
+# binascii.crc_hqx is the same CRC16 implemented in C
+def _calc16_binascii(crc, data):
+    if isinstance(data, list):
+        data = bytes(data)
+    return binascii.crc_hqx(data, crc & 0xffff)
 
 def calc16(crc, data):
-    LUT = [
-        0x0000, 0x1021, 0x2042, 0x3063, 0x4084, 0x50A5, 0x60C6, 0x70E7,
-        0x8108, 0x9129, 0xA14A, 0xB16B, 0xC18C, 0xD1AD, 0xE1CE, 0xF1EF,
-        0x1231, 0x0210, 0x3273, 0x2252, 0x52B5, 0x4294, 0x72F7, 0x62D6,
-        0x9339, 0x8318, 0xB37B, 0xA35A, 0xD3BD, 0xC39C, 0xF3FF, 0xE3DE,
-        0x2462, 0x3443, 0x0420, 0x1401, 0x64E6, 0x74C7, 0x44A4, 0x5485,
-        0xA56A, 0xB54B, 0x8528, 0x9509, 0xE5EE, 0xF5CF, 0xC5AC, 0xD58D,
-        0x3653, 0x2672, 0x1611, 0x0630, 0x76D7, 0x66F6, 0x5695, 0x46B4,
-        0xB75B, 0xA77A, 0x9719, 0x8738, 0xF7DF, 0xE7FE, 0xD79D, 0xC7BC,
-        0x48C4, 0x58E5, 0x6886, 0x78A7, 0x0840, 0x1861, 0x2802, 0x3823,
-        0xC9CC, 0xD9ED, 0xE98E, 0xF9AF, 0x8948, 0x9969, 0xA90A, 0xB92B,
-        0x5AF5, 0x4AD4, 0x7AB7, 0x6A96, 0x1A71, 0x0A50, 0x3A33, 0x2A12,
-        0xDBFD, 0xCBDC, 0xFBBF, 0xEB9E, 0x9B79, 0x8B58, 0xBB3B, 0xAB1A,
-        0x6CA6, 0x7C87, 0x4CE4, 0x5CC5, 0x2C22, 0x3C03, 0x0C60, 0x1C41,
-        0xEDAE, 0xFD8F, 0xCDEC, 0xDDCD, 0xAD2A, 0xBD0B, 0x8D68, 0x9D49,
-        0x7E97, 0x6EB6, 0x5ED5, 0x4EF4, 0x3E13, 0x2E32, 0x1E51, 0x0E70,
-        0xFF9F, 0xEFBE, 0xDFDD, 0xCFFC, 0xBF1B, 0xAF3A, 0x9F59, 0x8F78,
-        0x9188, 0x81A9, 0xB1CA, 0xA1EB, 0xD10C, 0xC12D, 0xF14E, 0xE16F,
-        0x1080, 0x00A1, 0x30C2, 0x20E3, 0x5004, 0x4025, 0x7046, 0x6067,
-        0x83B9, 0x9398, 0xA3FB, 0xB3DA, 0xC33D, 0xD31C, 0xE37F, 0xF35E,
-        0x02B1, 0x1290, 0x22F3, 0x32D2, 0x4235, 0x5214, 0x6277, 0x7256,
-        0xB5EA, 0xA5CB, 0x95A8, 0x8589, 0xF56E, 0xE54F, 0xD52C, 0xC50D,
-        0x34E2, 0x24C3, 0x14A0, 0x0481, 0x7466, 0x6447, 0x5424, 0x4405,
-        0xA7DB, 0xB7FA, 0x8799, 0x97B8, 0xE75F, 0xF77E, 0xC71D, 0xD73C,
-        0x26D3, 0x36F2, 0x0691, 0x16B0, 0x6657, 0x7676, 0x4615, 0x5634,
-        0xD94C, 0xC96D, 0xF90E, 0xE92F, 0x99C8, 0x89E9, 0xB98A, 0xA9AB,
-        0x5844, 0x4865, 0x7806, 0x6827, 0x18C0, 0x08E1, 0x3882, 0x28A3,
-        0xCB7D, 0xDB5C, 0xEB3F, 0xFB1E, 0x8BF9, 0x9BD8, 0xABBB, 0xBB9A,
-        0x4A75, 0x5A54, 0x6A37, 0x7A16, 0x0AF1, 0x1AD0, 0x2AB3, 0x3A92,
-        0xFD2E, 0xED0F, 0xDD6C, 0xCD4D, 0xBDAA, 0xAD8B, 0x9DE8, 0x8DC9,
-        0x7C26, 0x6C07, 0x5C64, 0x4C45, 0x3CA2, 0x2C83, 0x1CE0, 0x0CC1,
-        0xEF1F, 0xFF3E, 0xCF5D, 0xDF7C, 0xAF9B, 0xBFBA, 0x8FD9, 0x9FF8,
-        0x6E17, 0x7E36, 0x4E55, 0x5E74, 0x2E93, 0x3EB2, 0x0ED1, 0x1EF0
-    ]
+    return _calc16(crc, data)
+
+
+# Incremental CRC16 so headers, data and trailers can be checked piecewise without joining them
+class Crc16:
+    
+    def __init__(self, data=None, crc=0):
+        self.crc = crc & 0xffff
+        self.length = 0
+        if data is not None:
+            self.update(data)
+    
+    def update(self, data):
+        self.crc = calc16(self.crc, data)
+        self.length += len(data)
+    
+    def digest(self):
+        return self.crc
+    
+    def copy(self):
+        other = Crc16(crc=self.crc)
+        other.length = self.length
+        return other
+
+
+# Multiply two polynomials modulo the CRC16 polynomial (x^16 + x^12 + x^5 + 1)
+def _mulmod16(a, b):
+    product = 0
+    while b:
+        if b & 1:
+            product ^= a
+        b >>= 1
+        a <<= 1
+        if a & 0x10000:
+            a ^= 0x11021
+    return product
+
+# x^(8*num_bytes) modulo the CRC16 polynomial - i.e. the effect of running num_bytes zeros through the CRC
+def _zeros_operator16(num_bytes):
+    result = 1
+    power = 0x100 # x^8
+    while num_bytes:
+        if num_bytes & 1:
+            result = _mulmod16(result, power)
+        power = _mulmod16(power, power)
+        num_bytes >>= 1
+    return result
+
+# Get the CRC of A followed by B from the CRC of A and the CRC of B, where len_b is the length of B
+# and crc_b was calculated starting from 0. Takes O(log(len_b)) rather than rerunning the CRC over B
+def crc16_combine(crc_a, crc_b, len_b):
+    return _mulmod16(crc_a & 0xffff, _zeros_operator16(len_b)) ^ (crc_b & 0xffff)
+
+
+##########################
+# Checksum registry
+
+# A checksum that can be used to protect the frames on a link
+# id is what gets sent over the wire when a link is initialised and width is in bytes
+# calc(data, value=0) takes a previous result as value so data can be checked piecewise
+class Checksum:
+    
+    def __init__(self, id, name, width, calc):
+        self.id = id
+        self.name = name
+        self.width = width
+        self.calc = calc
+    
+    # Checksums are sent least significant byte first
+    def to_bytes(self, value):
+        return value.to_bytes(self.width, byteorder='little')
+    
+    def from_bytes(self, data):
+        return int.from_bytes(data, byteorder='little')
+
+def _make_crc16():
+    def calc(data, value=0):
+        return calc16(value, data)
+    return calc
+
+# CRC-8/SMBUS (polynomial 0x07)
+def _make_crc8():
+    table = []
+    for i in range(256):
+        crc = i
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x07) if crc & 0x80 else (crc << 1)
+        table.append(crc & 0xff)
+    def calc(data, value=0):
+        for byte in data:
+            value = table[value ^ byte]
+        return value
+    return calc
+
+# CRC-32C (Castagnoli, reflected polynomial 0x82F63B78)
+_crc32c_table = None # Only built the first time the pure Python version is used
+
+def _crc32c_python(data, value=0):
+    global _crc32c_table
+    if _crc32c_table == None:
+        _crc32c_table = []
+        for i in range(256):
+            crc = i
+            for bit in range(8):
+                crc = ((crc >> 1) ^ 0x82F63B78) if crc & 1 else (crc >> 1)
+            _crc32c_table.append(crc)
+    table = _crc32c_table
+    crc = value ^ 0xffffffff
     for byte in data:
-        crc = ((crc << 8) & 0xff00) ^ LUT[((crc >> 8) & 0xff) ^ byte]
-    return crc & 0xffff
\ No newline at end of file
+        crc = table[(crc ^ byte) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+def _crc32c_c(data, value=0):
+    if isinstance(data, list):
+        data = bytes(data)
+    return _crc32c_ext.crc32c(data, value)
+
+def _make_crc32c():
+    def calc(data, value=0):
+        return _crc32c(data, value)
+    return calc
+
+_checksum_types = {} # name: (id, width, make_calc)
+_checksums = {} # name: Checksum - only built the first time they are asked for
+
+def register_checksum(id, name, width, make_calc):
+    for (other_id, other_width, other_make_calc) in _checksum_types.values():
+        assert other_id != id
+    _checksum_types[name] = (id, width, make_calc)
+
+# Look up a checksum by name or by its wire id, raises KeyError if it isn't registered
+def get_checksum(name_or_id):
+    name = name_or_id
+    if isinstance(name_or_id, int):
+        names = [name for (name, info) in _checksum_types.items() if info[0] == name_or_id]
+        if len(names) == 0:
+            raise KeyError(name_or_id)
+        name = names[0]
+    if name not in _checksums:
+        (id, width, make_calc) = _checksum_types[name]
+        _checksums[name] = Checksum(id, name, width, make_calc())
+    return _checksums[name]
+
+def checksum_names():
+    return list(_checksum_types.keys())
+
+# CRC16 is id 0 so links that don't negotiate anything keep the original frame format
+register_checksum(0, 'crc16', 2, _make_crc16)
+register_checksum(1, 'crc8', 1, _make_crc8)
+register_checksum(2, 'crc32c', 4, _make_crc32c)
+
+
+##########################
+# Backends - fastest first, see backends.py
+
+CALC16_IMPLEMENTATIONS = [(backends.PYTHON, calc16_slice8)]
+if binascii != None:
+    CALC16_IMPLEMENTATIONS.insert(0, ('binascii', _calc16_binascii))
+CRC32C_IMPLEMENTATIONS = [(backends.PYTHON, _crc32c_python)]
+if _crc32c_ext != None:
+    CRC32C_IMPLEMENTATIONS.insert(0, ('crc32c', _crc32c_c))
+
+selected_backends = {}
+
+# name is backends.AUTO, backends.PYTHON, an implementation name or None to use the SERIAL_PROTOCOL_BACKEND
+# environment variable
+def set_backend(name=None):
+    global _calc16, _crc32c
+    (selected_backends['calc16'], _calc16) = backends.select(CALC16_IMPLEMENTATIONS, name)
+    (selected_backends['crc32c'], _crc32c) = backends.select(CRC32C_IMPLEMENTATIONS, name)
+
+set_backend()
+
+
+##########################
+# Test
+
+import random
+import traceback
+
+def basic_test():
+    # CRC-16/XMODEM check value
+    assert calc16(0, b'123456789') == 0x31C3
+    assert calc16_slice4(0, b'123456789') == 0x31C3
+    assert calc16_slice8(0, b'123456789') == 0x31C3
+
+def slicing_test():
+    for i in range(1000):
+        data = bytes([random.randint(0, 255) for i in range(random.randint(0, 300))])
+        init = random.randint(0, 0xffff)
+        exp = _calc16_bytewise(init, data)
+        assert calc16(init, data) == exp
+        assert calc16_slice4(init, data) == exp
+        assert calc16_slice8(init, data) == exp
+        assert calc16_slice8(init, memoryview(data)) == exp
+        assert calc16_slice8(init, list(data)) == exp
+
+def incremental_test():
+    for i in range(200):
+        data = bytes([random.randint(0, 255) for i in range(random.randint(0, 300))])
+        exp = calc16(0, data)
+        checksum = Crc16()
+        pos = 0
+        while pos < len(data):
+            length = random.randint(1, 20)
+            checksum.update(data[pos:pos+length])
+            pos += length
+            # A copy carries on independently
+            copy = checksum.copy()
+            copy.update(b'abc')
+            assert copy.digest() == calc16(0, data[:pos] + b'abc')
+        assert checksum.digest() == exp
+        assert checksum.length == len(data)
+        assert Crc16(data).digest() == exp
+
+def combine_test():
+    for i in range(200):
+        a = bytes([random.randint(0, 255) for i in range(random.randint(0, 300))])
+        b = bytes([random.randint(0, 255) for i in range(random.randint(0, 300))])
+        init = random.randint(0, 0xffff)
+        assert crc16_combine(calc16(init, a), calc16(0, b), len(b)) == calc16(init, a + b)
+
+def checksum_registry_test():
+    # Check values for b'123456789'
+    check_values = {'crc16': 0x31C3, 'crc8': 0xF4, 'crc32c': 0xE3069283}
+    for name in checksum_names():
+        checksum = get_checksum(name)
+        assert get_checksum(name) is checksum
+        assert get_checksum(checksum.id) is checksum
+        assert checksum.calc(b'123456789') == check_values[name]
+        # Continuing from a previous value is the same as checking it all in one go
+        assert checksum.calc(b'6789', checksum.calc(b'12345')) == check_values[name]
+        assert checksum.from_bytes(checksum.to_bytes(check_values[name])) == check_values[name]
+        assert len(checksum.to_bytes(check_values[name])) == checksum.width
+    try:
+        get_checksum(0x7F)
+        assert 0
+    except KeyError:
+        pass
+
+
+if __name__ == "__main__":
+    tests = [basic_test, slicing_test, incremental_test, combine_test, checksum_registry_test]
+    tests_passed = 0
+    for test in tests:
+        try:
+            test()
+            tests_passed += 1
+        except:
+            traceback.print_exc()
+            print(test, ": Test failed")
+            continue
+    print("{}/{} Tests succeeded".format(tests_passed, len(tests)))
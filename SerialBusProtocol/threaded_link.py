@@ -0,0 +1,296 @@
+# Runs a WindowedProtocol on its own I/O thread so the bus keeps going while the application is busy.
+# The I/O thread owns the reader, writer and protocol: it calls process_rx/process_tx, runs the retransmit
+# timers and sends the ACKs. The application only hands frames over through queues, with send() and receive()
+# which can be called from any thread.
+#
+#   link = ThreadedLink(id, connected_ids, writer, reader)
+#   link.start()
+#   link.send(dst, b'hello')
+#   (src, frame) = link.receive()
+#   link.stop()
+
+import random
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+
+from windowed_protocol import WindowedProtocol
+
+
+# WindowedProtocol clock for real time
+class MonotonicClock:
+    def time(self):
+        return time.monotonic()
+
+
+class ThreadedLink:
+    # Frames handed over in each direction that haven't been taken yet. Past this send() blocks, and received
+    # frames are left with the protocol so its receive window closes and the senders are held back
+    TX_HANDOFF_FRAMES = 256
+    RX_HANDOFF_FRAMES = 256
+    # Longest the I/O thread sleeps between checking the reader
+    POLL_INTERVAL = 0.0005
+
+    # writer, reader and any WindowedProtocol keyword options are handed to the protocol, which only the I/O
+    # thread uses once started
+    def __init__(self, id, connected_ids, writer, reader, **options):
+        self.protocol = WindowedProtocol(id, MonotonicClock(), connected_ids, writer, reader, **options)
+        # Application -> I/O thread. The semaphore counts free places, one is given back as each frame is submitted
+        self.tx_queue = queue.SimpleQueue()
+        self.tx_slots = threading.Semaphore(self.TX_HANDOFF_FRAMES)
+        # I/O thread -> application
+        self.rx_queue = queue.SimpleQueue()
+        # Only used by the I/O thread - frames taken from tx_queue waiting for room in the window
+        self.tx_pending = dict([(dst, deque()) for dst in connected_ids])
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+        self.error = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.__run, name="ThreadedLink {}".format(self.protocol.id), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+    # Queue a frame for dst, any bytes-like object or list of ints. It's copied so the caller can reuse it.
+    # Blocks while TX_HANDOFF_FRAMES frames are waiting, returns False if that's longer than timeout
+    def send(self, dst, frame, timeout=None):
+        self.__check()
+        if not self.tx_slots.acquire(timeout=timeout):
+            return False
+        if self.error != None:
+            # Woken because the I/O thread failed, pass it on to any other sender waiting
+            self.tx_slots.release()
+            self.__check()
+        self.tx_queue.put((dst, bytes(frame)))
+        self.wakeup.set()
+        return True
+
+    # Returns (src, frame) for the next frame from any source, or None if there isn't one within timeout.
+    # frame is a memoryview like those from WindowedProtocol.get_rx_frames
+    def receive(self, timeout=None):
+        self.__check()
+        try:
+            received = self.rx_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if received == None:
+            # The I/O thread failed, leave the marker for any other receiver waiting
+            self.rx_queue.put(None)
+            self.__check()
+        # There may be frames waiting for room in the queue
+        self.wakeup.set()
+        return received
+
+    def __check(self):
+        if self.error != None:
+            raise ConnectionError("I/O thread failed") from self.error
+
+    def __run(self):
+        try:
+            while self.running:
+                self.wakeup.clear()
+                self.__take_tx_frames()
+                self.protocol.process_rx()
+                self.__hand_over_rx_frames()
+                self.__submit_tx_frames()
+                self.protocol.process_tx()
+                # Sleep until there's something to do - a timer, a frame from the application, or time to poll
+                timeout = self.POLL_INTERVAL
+                when = self.protocol.next_tx_time()
+                if when != None:
+                    timeout = min(timeout, max(when - self.protocol.clock.time(), 0))
+                if timeout > 0:
+                    self.wakeup.wait(timeout)
+        except Exception as e:
+            self.error = e
+            # Wake anything blocked in send() or receive() so it raises instead of waiting forever
+            self.rx_queue.put(None)
+            self.tx_slots.release()
+            raise
+
+    def __take_tx_frames(self):
+        while True:
+            try:
+                (dst, frame) = self.tx_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.tx_pending[dst].append(frame)
+
+    def __submit_tx_frames(self):
+        for (dst, frames) in self.tx_pending.items():
+            if len(frames) == 0:
+                continue
+            num_submitted = self.protocol.submit_many(dst, frames)
+            for i in range(num_submitted):
+                frames.popleft()
+                self.tx_slots.release()
+
+    def __hand_over_rx_frames(self):
+        room = self.RX_HANDOFF_FRAMES - self.rx_queue.qsize()
+        if room <= 0:
+            return
+        for received in self.protocol.receive_frames():
+            self.rx_queue.put(received)
+            room -= 1
+            if room == 0:
+                return
+
+
+##########################
+# Test
+
+# A bus where each node reads what the others write, safe to use from their I/O threads
+class DequeReader:
+    def __init__(self):
+        self.chunks = deque()
+
+    def read(self):
+        data = []
+        while len(self.chunks) > 0:
+            data.append(self.chunks.popleft())
+        return b''.join(data)
+
+class DequeWriter:
+    def __init__(self, readers):
+        self.readers = readers
+        self.max_bytes = 4096
+        self.corruption_rate = 0 # Chance of a byte being zeroed in each write
+
+    def write(self, data):
+        for reader in self.readers:
+            rx_data = bytearray(data)
+            if random.random() < self.corruption_rate:
+                rx_data[random.randint(0, len(rx_data)-1)] = 0
+            reader.chunks.append(bytes(rx_data))
+
+def create_links(num, corruption_rate=0, link_class=ThreadedLink, **options):
+    readers = [DequeReader() for i in range(num)]
+    links = []
+    for i in range(num):
+        writer = DequeWriter([reader for (k, reader) in enumerate(readers) if k != i])
+        writer.corruption_rate = corruption_rate
+        links.append(link_class(i, [k for k in range(num) if k != i], writer, readers[i], **options))
+    for link in links:
+        link.start()
+    return links
+
+# Several application threads per node send to every other node while the application "works" in between,
+# and each node has a thread taking what's received. Each frame says which thread sent it and its count
+def stress_test():
+    num_nodes = 3
+    num_senders = 3
+    num_frames = 200
+    links = create_links(num_nodes, corruption_rate=1/50, selective_repeat=True)
+    received = [[] for link in links]
+    def sender(link, sender_id):
+        for count in range(num_frames):
+            for dst in link.protocol.tx_windows:
+                length = random.randint(3, 100)
+                frame = bytes([sender_id, count & 0xff, count >> 8]) + bytes(random.randint(0, 255) for i in range(length - 3))
+                assert link.send(dst, frame, timeout=30)
+            if random.random() < 0.05:
+                time.sleep(0.002)
+    def receiver(link, received):
+        expected = (num_nodes - 1) * num_senders * num_frames
+        while len(received) < expected:
+            got = link.receive(timeout=30)
+            assert got != None
+            (src, frame) = got
+            received.append((src, frame[0], frame[1] | (frame[2] << 8)))
+            if random.random() < 0.01:
+                time.sleep(0.005)
+    threads = [threading.Thread(target=receiver, args=(links[i], received[i])) for i in range(num_nodes)]
+    threads += [threading.Thread(target=sender, args=(link, s)) for link in links for s in range(num_senders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(120)
+        assert not thread.is_alive()
+    for link in links:
+        link.stop()
+    # Everything arrives once, and in order for each sending thread
+    for (rx, frames) in enumerate(received):
+        for src in range(num_nodes):
+            if src != rx:
+                for s in range(num_senders):
+                    assert [count for (frame_src, sender_id, count) in frames
+                            if frame_src == src and sender_id == s] == list(range(num_frames))
+
+# send() waits while the handoff is full, and received frames back up into the protocol and hold up the sender
+def backpressure_test():
+    class SmallLink(ThreadedLink):
+        TX_HANDOFF_FRAMES = 8
+        RX_HANDOFF_FRAMES = 8
+    links = create_links(2, link_class=SmallLink)
+    (sender, receiver) = links
+    num_sent = 0
+    while sender.send(1, bytes(100), timeout=0.2):
+        num_sent += 1
+        assert num_sent < 10000
+    # Nothing has been taken so the receive side is full all the way back
+    assert receiver.rx_queue.qsize() <= SmallLink.RX_HANDOFF_FRAMES
+    assert 0 < len(receiver.protocol.rx_frames[0]) <= receiver.protocol.RX_QUEUE_FRAMES
+    for i in range(num_sent):
+        (src, frame) = receiver.receive(timeout=10)
+        assert src == 0 and frame == bytes(100)
+    assert receiver.receive(timeout=0.1) == None
+    for link in links:
+        link.stop()
+
+# If the I/O thread fails, send() and receive() calls already blocked raise instead of waiting forever
+def failure_test():
+    class SmallLink(ThreadedLink):
+        TX_HANDOFF_FRAMES = 8
+    failed = threading.Event()
+    class FailingReader:
+        def read(self):
+            if failed.is_set():
+                raise OSError("Device unplugged")
+            return b''
+    # Nothing answers so the link is never initialised and sent frames stay in the handoff
+    link = SmallLink(0, [1], DequeWriter([]), FailingReader())
+    link.start()
+    for i in range(SmallLink.TX_HANDOFF_FRAMES):
+        assert link.send(1, bytes(10), timeout=1)
+    raised = []
+    def call(function):
+        try:
+            function()
+        except ConnectionError:
+            raised.append(function)
+    calls = [lambda: link.send(1, bytes(10)), lambda: link.send(1, bytes(10)), link.receive, link.receive]
+    threads = [threading.Thread(target=call, args=(function,)) for function in calls]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    assert len(raised) == 0
+    failed.set()
+    for thread in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+    assert len(raised) == len(calls)
+    link.stop()
+
+
+if __name__ == "__main__":
+    tests = [stress_test, backpressure_test, failure_test]
+    tests_passed = 0
+    for test in tests:
+        try:
+            test()
+            tests_passed += 1
+        except:
+            traceback.print_exc()
+            print(test, ": Test failed")
+            continue
+    print("{}/{} Tests succeeded".format(tests_passed, len(tests)))
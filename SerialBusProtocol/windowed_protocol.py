@@ -1,11 +1,13 @@
 # Sliding window protocol
 # Used to ensure packets are send reliably and in order.
 
+import array
 import cobs
 import crc
 import test_node
 import random
 import traceback
+from collections import deque
 
 # Frames are encoded as:
 # dst+1, dst+1, cobs0, src, data0, ... , dataN, crc0, crc1, 0
@@ -13,185 +15,566 @@ import traceback
 # The destination is then added to the front so it can be read without running COBS
 # But this means the destination cannot be 0, so we add 1 to it
 # As the destination is also outside the CRC we duplicate it
+# The CRC defaults to CRC16 but each link can negotiate a different checksum (see crc.get_checksum)
+# in which case crc0, ... , crcN is the width of that checksum
 
-def encode_frame(src, dst, frame):
-    encoded = [src] + frame
-    crc16 = crc.calc16(0, encoded)
-    crc_byte0 = crc16 & 0xFF
-    crc_byte1 = (crc16 >> 8) & 0xFF
-    encoded = encoded + [crc_byte0, crc_byte1]
-    encoded = list(cobs.encode(bytearray(encoded))) + [0]
+DEFAULT_CHECKSUM = crc.get_checksum('crc16')
+
+# Sequence numbers wrap so they are compared with serial number arithmetic (RFC 1982)
+# Returns how many sequence numbers b is after a
+def sequence_distance(a, b, modulus):
+    return (b - a) % modulus
+
+# The most bytes a frame with length bytes of data can take on the wire
+def max_frame_length(length, checksum=DEFAULT_CHECKSUM):
+    return 3 + cobs.max_encoded_length(1 + length + checksum.width)
+
+# Write a frame straight into the bytearray buffer at offset, returns the number of bytes written
+# The data is given as a list of parts (e.g. type, payload, sequence number) so it never needs joining
+# The buffer needs max_frame_length() bytes free from offset
+def encode_frame_into(buffer, offset, src, dst, parts, checksum=DEFAULT_CHECKSUM):
     assert dst < 255
-    encoded = [dst+1, dst+1] + encoded # Add 1 to the destination to make sure it's never 0
-    return encoded
+    buffer[offset] = dst+1 # Add 1 to the destination to make sure it's never 0
+    buffer[offset+1] = dst+1
+    # Lay out the unencoded src, data and checksum one byte on from where the COBS data starts
+    # then COBS encode it where it is
+    start = offset + 3
+    buffer[start] = src
+    pos = start + 1
+    for part in parts:
+        length = len(part)
+        buffer[pos:pos+length] = part
+        pos += length
+    value = checksum.calc(memoryview(buffer)[start:pos])
+    buffer[pos:pos+checksum.width] = checksum.to_bytes(value)
+    pos += checksum.width
+    end = offset + 2 + cobs.encode_in_place(buffer, offset + 2, pos - start)
+    buffer[end] = 0
+    return end + 1 - offset
+
+# Frames can be lists of ints or anything with the buffer protocol (bytes, bytearray, memoryview, array etc.)
+# Buffers are returned as a flat byte view, without copying, so their length is in bytes
+def frame_bytes(frame):
+    if isinstance(frame, (list, bytes, bytearray)):
+        return frame
+    return memoryview(frame).cast('B')
+
+def encode_frame(src, dst, frame, checksum=DEFAULT_CHECKSUM):
+    buffer = bytearray(max_frame_length(len(frame), checksum))
+    length = encode_frame_into(buffer, 0, src, dst, [frame], checksum)
+    del buffer[length:]
+    return bytes(buffer)
+
+# Encode a batch of frames to the same destination into one joined buffer
+# Returns (encoded, offsets) where frame i is encoded[offsets[i]:offsets[i+1]]
+def encode_frames(src, dst, frames, checksum=DEFAULT_CHECKSUM):
+    buffer = bytearray(sum([max_frame_length(len(frame), checksum) for frame in frames]))
+    offsets = [0]
+    pos = 0
+    for frame in frames:
+        pos += encode_frame_into(buffer, pos, src, dst, [frame], checksum)
+        offsets.append(pos)
+    del buffer[pos:]
+    return (buffer, offsets)
 
-def decode_frame(rx_bytes):
+def decode_frame(rx_bytes, checksums_for_src=None):
     no_result = (None, None, None)
     # Get frame up to delimiter
     if 0 not in rx_bytes:
         return no_result
     end = rx_bytes.index(0)
-    frame = rx_bytes[:end]
+    frame = bytes(rx_bytes[:end])
     del rx_bytes[:end+1]
+    return parse_frame(frame, checksums_for_src)
+
+# Decode a single frame with the delimiter already removed, frame can be any bytes-like object
+# The returned frame data is a memoryview onto the decoded bytes so no further copies are made
+# checksums_for_src(src, type) gives the checksums to try, in order, for frames from src of that type
+def parse_frame(frame, checksums_for_src=None):
+    no_result = (None, None, None)
     if len(frame) < 5:
         return no_result
     # Check destination bytes
-    dst = frame.pop(0)-1
-    dst_check = frame.pop(0)-1
+    dst = frame[0]-1
+    dst_check = frame[1]-1
     if dst != dst_check:
         return no_result
     # COBS decode
+    decoded = bytearray(len(frame) - 2)
     try:
-        frame = list(cobs.decode(bytearray(frame)))
+        length = cobs.decode_into(frame[2:], decoded)
     except cobs.DecodeError:
         return no_result
-    # Check CRC
-    crc_byte1 = frame.pop(-1)
-    crc_byte0 = frame.pop(-1)
-    crc16 = (crc_byte1 << 8) | crc_byte0
-    if crc16 != crc.calc16(0, frame):
+    # Need at least the src and a type byte
+    if length < 2:
         return no_result
-    assert len(frame) > 1
-    src = frame.pop(0)
-    return (src, dst, frame)
+    decoded_mv = memoryview(decoded)[:length]
+    # The src and type bytes can't be trusted until the CRC passes, but we need them to know which checksum to use
+    src = decoded_mv[0]
+    checksums = [DEFAULT_CHECKSUM] if checksums_for_src == None else checksums_for_src(src, decoded_mv[1])
+    for checksum in checksums:
+        # Need at least the src, a type byte and the CRC
+        end = length - checksum.width
+        if end < 2:
+            continue
+        if checksum.from_bytes(decoded_mv[end:]) == checksum.calc(decoded_mv[:end]):
+            return (src, dst, decoded_mv[1:end])
+    return no_result
 
 
-class ByteBuffer:
+# Splits a stream of received bytes into decoded frames.
+# It remembers how far it has already searched for a delimiter so each byte is only
+# scanned once, however the stream is split up between reads.
+# addresses: if given, only frames to these destinations are decoded (include any broadcast address used).
+# The destination is the first byte of a frame so the rest of any other frame is skipped, up to the next
+# delimiter, without being COBS decoded, checksummed or even kept in the buffer
+class FrameDecoder:
+    
+    def __init__(self, checksums_for_src=None, addresses=None):
+        self.buffer = bytearray()
+        self.scan_pos = 0
+        self.checksums_for_src = checksums_for_src
+        self.addresses = None if addresses == None else frozenset(addresses)
+        self.skipping = False # Part way through a frame for someone else
+        self.num_skipped = 0 # Frames for other destinations that weren't decoded
+    
+    # Returns an iterator of (src, dst, frame) for every complete and valid frame received
+    def feed(self, data):
+        self.buffer.extend(data)
+        return self.__decode_frames()
+    
+    def __decode_frames(self):
+        while True:
+            if self.skipping:
+                end = self.buffer.find(0)
+                if end < 0:
+                    del self.buffer[:]
+                    return
+                del self.buffer[:end+1]
+                self.skipping = False
+            if self.addresses != None and len(self.buffer) > 0:
+                dst = self.buffer[0] - 1
+                # -1 is an empty frame (two delimiters in a row) which is dropped as usual
+                if dst >= 0 and dst not in self.addresses:
+                    self.num_skipped += 1
+                    self.skipping = True
+                    self.scan_pos = 0
+                    continue
+            end = self.buffer.find(0, self.scan_pos)
+            if end < 0:
+                # Wait for more data before looking for the delimiter again
+                self.scan_pos = len(self.buffer)
+                return
+            # Parse it in place - the view has to be released before the buffer can be resized
+            with memoryview(self.buffer) as buffer_mv:
+                (src, dst, frame) = parse_frame(buffer_mv[:end], self.checksums_for_src)
+            del self.buffer[:end+1]
+            self.scan_pos = 0
+            if frame != None:
+                yield (src, dst, frame)
+
+
+# Fixed size store for encoded frames, the oldest frame is always removed first.
+# Each frame is kept in one piece so it can be sent straight from the buffer. If a frame doesn't fit
+# before the end of the buffer the space at the end is skipped and it goes at the start
+class RingBuffer:
     
     def __init__(self, size):
-        self.buffer = []
-        self.frame_lengths = []
+        self.buffer = bytearray(size)
+        self.buffer_mv = memoryview(self.buffer)
         self.size = size
-        
-    def add_frame(self, src, dst, frame):
-        encoded = encode_frame(src, dst, frame)
-        if len(encoded) + len(self.buffer) < self.size:
-            self.buffer += encoded
-            self.frame_lengths.append(len(encoded))
+        self.records = deque() # [(offset, length)]
+        self.num_bytes = 0 # Not counting any space skipped at the end
+    
+    def __len__(self):
+        return len(self.records)
+    
+    # The most bytes that can be written in one piece
+    def free_space(self):
+        if len(self.records) == 0:
+            return self.size
+        first = self.records[0][0]
+        end = self.records[-1][0] + self.records[-1][1]
+        if self.records[-1][0] < first:
+            # Wrapped - the space is between the newest and oldest frames
+            return first - end
+        return max(self.size - end, first)
+    
+    # Returns the offset where length bytes can be written, or None if there isn't room
+    def reserve(self, length):
+        if len(self.records) == 0:
+            return 0 if length <= self.size else None
+        first = self.records[0][0]
+        end = self.records[-1][0] + self.records[-1][1]
+        if self.records[-1][0] < first:
+            return end if end + length <= first else None
+        if end + length <= self.size:
+            return end
+        if length <= first:
+            return 0
+        return None
+    
+    # Keep the length bytes written at offset (from reserve), returns a view of them
+    def push(self, offset, length):
+        self.records.append((offset, length))
+        self.num_bytes += length
+        return self.buffer_mv[offset:offset+length]
+    
+    def pop(self):
+        (offset, length) = self.records.popleft()
+        self.num_bytes -= length
+    
+    # Remove the newest frame
+    def pop_last(self):
+        (offset, length) = self.records.pop()
+        self.num_bytes -= length
+    
+    # Encode a frame straight into the buffer, returns a view of it or None if there isn't room
+    def add_frame(self, src, dst, parts, checksum=DEFAULT_CHECKSUM):
+        offset = self.reserve(max_frame_length(sum([len(part) for part in parts]), checksum))
+        if offset == None:
+            return None
+        return self.push(offset, encode_frame_into(self.buffer, offset, src, dst, parts, checksum))
+
+
+class ByteBuffer:
+    
+    def __init__(self, size):
+        self.ring = RingBuffer(size)
+        self.frames = deque()
+    
+    def free_space(self):
+        return self.ring.free_space()
+    
+    # Returns False if there isn't room for the frame
+    def add_frame(self, src, dst, frame, checksum=DEFAULT_CHECKSUM):
+        encoded = self.ring.add_frame(src, dst, [frame], checksum)
+        if encoded == None:
+            return False
+        self.frames.append(encoded)
+        return True
     
     def pop_next_frames(self, max_bytes):
         num_bytes = 0
-        while (len(self.frame_lengths) > 0) and (num_bytes + self.frame_lengths[0] <= max_bytes):
-            length = self.frame_lengths.pop(0)
-            num_bytes += length
+        data = []
+        while (len(self.frames) > 0) and (num_bytes + len(self.frames[0]) <= max_bytes):
+            encoded = self.frames.popleft()
+            num_bytes += len(encoded)
+            data.append(encoded)
         if num_bytes == 0:
             return None
-        data = self.buffer[:num_bytes]
-        self.buffer = self.buffer[num_bytes:]
-        return data
+        for encoded in data:
+            self.ring.pop()
+        # The space isn't reused until the next add_frame so the views can still be joined
+        return b''.join(data)
 
 
+# window_size: most frames that can be in flight (so the ids in the window are unique)
+# window_bytes: most encoded bytes that can be in flight, None for no limit
 class SlidingWindowByteBuffer:
     
-    def __init__(self, size, window_size, node_id):
+    def __init__(self, size, window_size, node_id, window_bytes=None):
         self.node_id = node_id
-        self.buffer = []
-        self.frame_info = [] # [(id, dst, length)]
+        # Each frame is kept encoded, so getting the next frames to send only touches the frames being sent
+        # The encoded frames are views onto a fixed size ring buffer
+        self.frames = deque() # [(id, dst, encoded)]
+        self.ring = RingBuffer(size)
+        # Index of where each (dst, id) is in the queue so acks don't need to search for it
+        # Positions count up from the first frame ever added so they don't change as frames are removed
+        # Ids wrap so there can be more than one position for the same (dst, id) - the oldest is first
+        self.positions = {} # {(dst, id): deque([position])}
+        # Positions of frames the other side has selectively acked - they don't need sending again
+        self.sacked = set()
+        # When each frame was first sent and which ones have been sent more than once, for measuring round trips
+        self.send_times = {} # {position: time}
+        self.resent = set()
+        self.num_retransmissions = 0
+        self.first_position = 0
         self.current_pos = 0
-        self.size = size
+        self.current_bytes = 0 # Bytes of the frames before current_pos
         self.window_size = window_size
+        self.window_bytes = window_bytes
+    
+    def num_frames(self):
+        return len(self.frames)
+    
+    # Bytes held in the queued frames
+    @property
+    def num_bytes(self):
+        return self.ring.num_bytes
+    
+    # The most bytes a new encoded frame can take
+    def free_space(self):
+        return self.ring.free_space()
     
     def end_of_window(self):
-        return ((self.current_pos >= self.window_size) or (self.current_pos >= len(self.frame_info)))
+        if (self.current_pos >= self.window_size) or (self.current_pos >= len(self.frames)):
+            return True
+        # The first frame is always allowed - if the other side has no room this is the probe to find out when it has
+        if self.window_bytes != None and self.current_pos > 0:
+            return self.current_bytes + len(self.frames[self.current_pos][2]) > self.window_bytes
+        return False
+    
+    def __next_pos(self):
+        self.current_bytes += len(self.frames[self.current_pos][2])
+        self.current_pos += 1
         
-    def get_next_frames(self, max_bytes):
+    # time: when the frames are being sent, to time the round trip when they're acked
+    def get_next_frames(self, max_bytes, time=0):
         if self.end_of_window():
             self.current_pos = 0
+            self.current_bytes = 0
         num_bytes = 0
-        first_pos = self.current_pos
-        while len(self.frame_info) > 0 and not self.end_of_window():
-            (id, dst, length) = self.frame_info[self.current_pos]
-            if num_bytes + length > max_bytes:
+        data = []
+        while not self.end_of_window():
+            if self.first_position + self.current_pos in self.sacked:
+                self.__next_pos()
+                continue
+            (id, dst, encoded) = self.frames[self.current_pos]
+            if num_bytes + len(encoded) > max_bytes:
                 break
-            num_bytes += length
-            self.current_pos += 1
+            num_bytes += len(encoded)
+            data.append(encoded)
+            position = self.first_position + self.current_pos
+            if position in self.send_times:
+                self.resent.add(position)
+                self.num_retransmissions += 1
+            else:
+                self.send_times[position] = time
+            self.__next_pos()
         if num_bytes == 0:
             return None
-        # Work out the starting byte position
-        start = 0
-        for i in range(first_pos):
-            (id, dst, length) = self.frame_info[i]
-            start += length
-        return self.buffer[start:(start+num_bytes)]
-    
-    def __find_dst_id_in_buffer(self, dst, id):
-        i = 0
-        for info in self.frame_info:
-            i += 1
-            (id0, dst0, length0) = info
-            if dst == dst0 and id == id0:
-                return i
-        return 0
+        return b''.join(data)
+    
+    def __append(self, id, dst, encoded):
+        key = (dst, id)
+        if key not in self.positions:
+            self.positions[key] = deque()
+        self.positions[key].append(self.first_position + len(self.frames))
+        self.frames.append((id, dst, encoded))
+    
+    def __pop_first(self):
+        (id, dst, encoded) = self.frames.popleft()
+        self.ring.pop()
+        key = (dst, id)
+        self.positions[key].popleft()
+        if len(self.positions[key]) == 0:
+            del self.positions[key]
+        self.sacked.discard(self.first_position)
+        self.send_times.pop(self.first_position, None)
+        self.resent.discard(self.first_position)
+        self.first_position += 1
     
     # Go through the list of frames and acknowledge everything up to this id and destination
+    # This only costs as much as the number of frames acked - stale acks for frames no longer queued are free
+    # Returns when the acked frame was sent if it was only sent once (so the ack can only be for that send),
+    # otherwise None
     def ack_frame(self, dst, id):
-        if len(self.frame_info) > 0:
-            # Check if acked ID actually exists in the queue
-            end = self.__find_dst_id_in_buffer(dst, id)
-            if end > 0:
-                num_acked = 0
-                for i in range(end):
-                    (id0, dst0, length0) = self.frame_info[i]
-                    if dst0 != dst:
-                        # The point where we encounter a frame to a different destination
-                        # We need to stop and wait for that ack before continuing
-                        break
-                    self.buffer = self.buffer[length0:]
-                    if self.current_pos > 0:
-                        self.current_pos -= 1
-                    num_acked += 1
-                del self.frame_info[:num_acked]
-        
-    def add_frame(self, src, dst, id, frame):
-        encoded = encode_frame(src, dst, frame)
-        if len(encoded) + len(self.buffer) < self.size:
-            self.buffer += encoded
-            self.frame_info.append((id, dst, len(encoded)))
-        else:
-            assert 0 # TODO
+        # Check if acked ID actually exists in the queue
+        positions = self.positions.get((dst, id))
+        if positions == None:
+            return None
+        position = positions[0]
+        # Only frames in the window can have been sent. If the id is further on it's from before the ids wrapped
+        if position - self.first_position >= self.window_size:
+            return None
+        send_time = None
+        if position not in self.resent:
+            send_time = self.send_times.get(position)
+        num_acked = position - self.first_position + 1
+        for i in range(num_acked):
+            (id0, dst0, encoded0) = self.frames[0]
+            if dst0 != dst:
+                # The point where we encounter a frame to a different destination
+                # We need to stop and wait for that ack before continuing
+                return None
+            self.__pop_first()
+            if self.current_pos > 0:
+                self.current_pos -= 1
+                self.current_bytes -= len(encoded0)
+        return send_time
+    
+    # Take back the newest frame if it has this id and hasn't been sent yet, e.g. to add more to it.
+    # Returns False if it's been sent
+    def pop_last_unsent(self, id):
+        position = self.first_position + len(self.frames) - 1
+        if len(self.frames) <= self.current_pos or position in self.send_times or self.frames[-1][0] != id:
+            return False
+        (id, dst, encoded) = self.frames.pop()
+        self.ring.pop_last()
+        key = (dst, id)
+        self.positions[key].pop()
+        if len(self.positions[key]) == 0:
+            del self.positions[key]
+        return True
     
+    # Mark frames in the window as received so they are skipped when the window is re-sent
+    def sack_frames(self, dst, ids):
+        for id in ids:
+            positions = self.positions.get((dst, id))
+            if positions != None and positions[0] - self.first_position < self.window_size:
+                self.sacked.add(positions[0])
         
+    # Returns False if there isn't room for the frame
+    def add_frame(self, src, dst, id, frame, checksum=DEFAULT_CHECKSUM):
+        return self.add_frame_parts(src, dst, id, [frame], checksum)
+    
+    # The frame is the parts joined together, they're encoded straight into the ring
+    def add_frame_parts(self, src, dst, id, parts, checksum=DEFAULT_CHECKSUM):
+        encoded = self.ring.add_frame(src, dst, parts, checksum)
+        if encoded == None:
+            return False
+        self.__append(id, dst, encoded)
+        return True
+    
+    # Add a batch of frames to the same destination, returns how many there was room for
+    def add_frames(self, src, dst, ids, frames, checksum=DEFAULT_CHECKSUM):
+        for i in range(len(frames)):
+            if not self.add_frame(src, dst, ids[i], frames[i], checksum):
+                return i
+        return len(frames)
+
 
 class WindowedProtocol:
     
     # TODO: pass in
+    # All the memory for sending is allocated up front - one direct buffer and a window buffer per destination.
+    # TX_WINDOW_BUFFER_SIZE is shared equally between the destinations' window buffers
     TX_DIRECT_BUFFER_SIZE = 100000
     TX_WINDOW_BUFFER_SIZE = 100000
-    WINDOW_SIZE = 10 # TODO: should this be in bytes?
-    WRAP_TIME = 0.001 # 1ms
+    # The window to each destination is limited in bytes, and by how much room the other side says it has left.
+    # There is also a limit on the number of frames, which can't be more than half the sequence numbers
+    # so an old sequence number can't be mistaken for a new one
+    WINDOW_BYTES = 4096
+    WINDOW_SIZE = 64
+    # Sequence numbers can be 1 or 2 bytes, agreed per link during INITIALISE
+    SEQUENCE_BYTES = (1, 2)
+    # Bytes of received frames held for each source until they are taken with get_rx_frames
+    RX_BUFFER_SIZE = 8192
+    # And the most frames, so lots of small (or empty) frames can't build up either. The window closes at
+    # this many, the frames already in flight are still taken
+    RX_QUEUE_FRAMES = 256
+    # Frames received from a source are acked together with one ACK, sent at the end of process_rx or
+    # once ACK_DELAY seconds have passed since the first frame that needed it. None acks every frame on its own
+    ACK_DELAY = 0
+    # Retransmit timeout per destination, worked out from the measured round trip times (RFC 6298)
+    INITIAL_RTO = 0.001 # 1ms
+    MIN_RTO = 0.0001 # 100us
+    MAX_RTO = 1.0
+    RTT_ALPHA = 1/8
+    RTT_BETA = 1/4
+    TX_QUANTUM = 256 # Bytes each destination can send per round of the scheduler
+    # With aggregation small frames to the same destination are packed into one AGGREGATE frame up to this size
+    AGGREGATE_SIZE = 128
     
     # Requests 
-    INITIALISE = 0x02
-    FRAME = 0x03
+    INITIALISE = 0x02 # [INITIALISE, sequence num low byte, checksum id, sequence bytes, sequence num high bytes...]
+    FRAME = 0x03 # [FRAME, frame..., sequence num (sequence bytes, little endian)]
+    AGGREGATE = 0x04 # [AGGREGATE, length0, frame0..., length1, frame1..., sequence num]
+    FRAME_HEADER = bytes([FRAME])
     # Responses
     UNINITIALISED = 0x82
-    INITIALISED = 0x83
+    INITIALISED = 0x83 # [INITIALISED, checksum id, sequence bytes]
     ACK = 0x84
+    # Always sent with the default checksum
+    INIT_TYPES = (INITIALISE, UNINITIALISED, INITIALISED)
     
     
-    def __init__(self, id, clock, connected_ids, writer, reader) -> None:
+    # checksum: name of the checksum to ask the other nodes to use for the frames we send them
+    # selective_repeat: keep frames received out of order and tell the sender which ones arrived
+    # (in the ACK) so only the missing ones are sent again. Otherwise they are dropped (go-back-N)
+    # aggregate: pack submitted frames into the last frame queued for the destination while it hasn't been sent
+    # and there's room, so small frames share the header, sequence number and checksum
+    # sequence_bytes: size of sequence number to ask the other nodes to use, 2 allows a window of more than 128 frames
+    def __init__(self, id, clock, connected_ids, writer, reader, checksum='crc16', selective_repeat=False,
+                 aggregate=False, sequence_bytes=1) -> None:
         self.verbose = 0
+        # Called with the destination when there's room again after submit_tx_frames couldn't take everything
+        self.on_tx_space = None
+        # If set, called with (src, frame) for each frame as soon as it's received in order, instead of the frame
+        # waiting for get_rx_frames or receive_frames. The frame is a memoryview like those from get_rx_frames
+        self.on_frame = None
         self.id = id
-        self.rx_bytes = []
+        self.selective_repeat = selective_repeat
+        self.aggregate = aggregate
+        assert sequence_bytes in self.SEQUENCE_BYTES
+        self.sequence_bytes = sequence_bytes
+        self.checksum = crc.get_checksum(checksum)
+        self.rx_decoder = FrameDecoder(self.__rx_checksums, [id])
         self.clock = clock
         self.writer = writer
         self.reader = reader
         
-        self.tx_window_buffer = SlidingWindowByteBuffer(self.TX_WINDOW_BUFFER_SIZE, self.WINDOW_SIZE, id)
         self.tx_direct_buffer = ByteBuffer(self.TX_DIRECT_BUFFER_SIZE) # For direct frames and responses
-        self.time_end_reached = 0
+        # Destinations take turns to send from their window (deficit round robin)
+        self.tx_order = deque(connected_ids)
         # Per destination attributes
+        # Each destination has its own window so a slow or dead node can't hold up frames to the others
+        self.tx_windows = {}
+        self.tx_full = set() # Destinations that have turned down frames since the last time they had room
+        self.tx_aggregate = {} # {dst: (id, [frames])} the newest frame queued that more could be added to (copies)
+        self.tx_deficit = {}
+        self.time_end_reached = {}
+        self.srtt = {}
+        self.rttvar = {}
+        self.rto = {}
         self.tx_sequence_num = {}
         self.exp_rx_sequence_num = {}
+        # Links start on 1 byte sequence numbers until the INITIALISE exchange agrees another size
+        self.tx_sequence_bytes = {}
+        self.rx_sequence_bytes = {}
         self.egress_initialised = {}
         self.ingress_initialised = {}
         self.rx_frames = {}
+        self.rx_out_of_order = {} # {src: {sequence_num: frame}}
+        self.rx_buffered = {} # Bytes held in rx_frames and rx_out_of_order
+        self.rx_out_of_order_bytes = {} # Of which in rx_out_of_order
+        self.advertised_rx_window = {} # What we last told the source
+        self.pending_acks = {} # {src: when the first frame not acked yet arrived}
+        self.num_acks_sent = 0
+        # Links start on the default checksum until the INITIALISE exchange agrees another one
+        self.tx_checksum = {}
+        self.rx_checksum = {}
+        window_buffer_size = self.TX_WINDOW_BUFFER_SIZE // max(len(connected_ids), 1)
         for dst in connected_ids:
+            self.tx_windows[dst] = SlidingWindowByteBuffer(window_buffer_size, min(self.WINDOW_SIZE, 128), id,
+                                                           self.WINDOW_BYTES)
+            self.tx_deficit[dst] = 0
+            self.time_end_reached[dst] = None
+            self.srtt[dst] = None
+            self.rttvar[dst] = None
+            self.rto[dst] = self.INITIAL_RTO
             self.tx_sequence_num[dst] = 0
             self.exp_rx_sequence_num[dst] = 0
+            self.tx_sequence_bytes[dst] = 1
+            self.rx_sequence_bytes[dst] = 1
             self.egress_initialised[dst] = False
             self.ingress_initialised[dst] = False
-            self.rx_frames[dst] = []
+            self.rx_frames[dst] = deque()
+            self.rx_out_of_order[dst] = {}
+            self.rx_out_of_order_bytes[dst] = 0
+            self.rx_buffered[dst] = 0
+            self.advertised_rx_window[dst] = self.RX_BUFFER_SIZE
+            self.tx_checksum[dst] = DEFAULT_CHECKSUM
+            self.rx_checksum[dst] = DEFAULT_CHECKSUM
+    
+    def __tx_modulus(self, dst):
+        return 1 << (8 * self.tx_sequence_bytes[dst])
+    
+    def __rx_modulus(self, src):
+        return 1 << (8 * self.rx_sequence_bytes[src])
+    
+    # Most frames in flight on a link with this many sequence numbers
+    def __window_size(self, modulus):
+        return min(self.WINDOW_SIZE, modulus // 2)
+    
+    # Frames on a link are only accepted with the checksum agreed for it, so corrupted frames can't get through
+    # under a weaker one. The init frames are always sent with the default checksum as the two sides may not
+    # agree yet (one of them has restarted or the INITIALISED was lost)
+    def __rx_checksums(self, src, frame_type):
+        if frame_type in self.INIT_TYPES:
+            return [DEFAULT_CHECKSUM]
+        return [self.rx_checksum.get(src, DEFAULT_CHECKSUM)]
     
     def __tx_responses(self, max_bytes):
         data = self.tx_direct_buffer.pop_next_frames(max_bytes)
@@ -202,34 +585,99 @@ class WindowedProtocol:
         self.writer.write(data)
         return len(data)
     
+    # If a window has reached its end wait for the acks before starting from the beginning.
+    # If they don't come in time the timeout is doubled for next time
+    def __window_ready(self, dst):
+        window = self.tx_windows[dst]
+        if window.num_frames() == 0:
+            return False
+        if window.end_of_window():
+            if self.time_end_reached[dst] == None:
+                self.time_end_reached[dst] = self.clock.time()
+            if self.clock.time() < self.time_end_reached[dst] + self.rto[dst]:
+                return False
+            self.time_end_reached[dst] = None
+            self.rto[dst] = min(self.rto[dst] * 2, self.MAX_RTO)
+            if self.verbose > 1:
+                print(self.id, dst, "Wrapped")
+        return True
+    
+    def __update_rto(self, dst, rtt):
+        if self.srtt[dst] == None:
+            self.srtt[dst] = rtt
+            self.rttvar[dst] = rtt / 2
+        else:
+            self.rttvar[dst] = (1 - self.RTT_BETA) * self.rttvar[dst] + self.RTT_BETA * abs(self.srtt[dst] - rtt)
+            self.srtt[dst] = (1 - self.RTT_ALPHA) * self.srtt[dst] + self.RTT_ALPHA * rtt
+        self.__reset_rto(dst)
+    
+    # Undo any backoff once acks are coming through again. Without this the timeout would stay backed off while
+    # only retransmitted frames are being acked, as those can't be timed
+    def __reset_rto(self, dst):
+        if self.srtt[dst] != None:
+            rto = self.srtt[dst] + 4 * self.rttvar[dst]
+            self.rto[dst] = min(max(rto, self.MIN_RTO), self.MAX_RTO)
+    
+    # Deficit round robin across the destination windows - each round every destination with
+    # frames to send gets another TX_QUANTUM bytes of credit and sends as much as the credit allows.
+    # Rounds continue while any destination has a frame that only needs more credit, so a frame bigger
+    # than TX_QUANTUM still goes out in this write.
+    # Destinations with nothing to send (or waiting to wrap) lose their credit so they can't save up
     def __tx_requests(self, max_bytes):
-        # If reached the end of the window pause before starting from the beginning
-        if self.tx_window_buffer.end_of_window():
-            if self.time_end_reached == 0:
-                self.time_end_reached = self.clock.time()
-            if self.clock.time() < self.time_end_reached + self.WRAP_TIME:
-                return 0
-            else:
-                self.time_end_reached = 0
-                if self.verbose > 1:
-                    print(self.id, "Wrapped")
-        data = self.tx_window_buffer.get_next_frames(max_bytes)
-        if data == None:
+        data = []
+        bytes_left = max_bytes
+        waiting = True
+        while waiting and bytes_left > 0:
+            waiting = False
+            for i in range(len(self.tx_order)):
+                dst = self.tx_order[0]
+                self.tx_order.rotate(-1)
+                if not self.__window_ready(dst):
+                    self.tx_deficit[dst] = 0
+                    continue
+                self.tx_deficit[dst] += self.TX_QUANTUM
+                window = self.tx_windows[dst]
+                frames = window.get_next_frames(min(self.tx_deficit[dst], bytes_left), self.clock.time())
+                if frames != None:
+                    self.tx_deficit[dst] -= len(frames)
+                    bytes_left -= len(frames)
+                    data.append(frames)
+                # If the next frame didn't fit it could with more credit, unless it's bigger than the space left
+                if not window.end_of_window() and self.tx_deficit[dst] < bytes_left:
+                    waiting = True
+                if bytes_left <= 0:
+                    break
+        if len(data) == 0:
             return 0
+        data = b''.join(data)
         if self.verbose > 1:
             print(self.id, "Requests: Sending", data)
         self.writer.write(data)
         return len(data)
     
+    def num_tx_window_frames(self):
+        return sum([window.num_frames() for window in self.tx_windows.values()])
+    
+    # Counters for keeping an eye on the bus
+    def stats(self):
+        return {
+            'acks_sent': self.num_acks_sent,
+            'retransmissions': sum([window.num_retransmissions for window in self.tx_windows.values()]),
+            'rx_skipped': self.rx_decoder.num_skipped, # Frames for other nodes that weren't decoded
+        }
+    
     def process_tx(self):
+        self.__send_acks()
         for dst in self.egress_initialised.keys():
             # Send an init request - but limit it to as many inits in the queue as there are connections
             # so we don't overload the other side
-            if not self.egress_initialised[dst] and len(self.tx_window_buffer.frame_info) < len(self.egress_initialised.keys()):
-                    frame = [self.INITIALISE, self.tx_sequence_num[dst]]
+            if not self.egress_initialised[dst] and self.num_tx_window_frames() < len(self.egress_initialised.keys()):
+                    sequence_num = self.tx_sequence_num[dst]
+                    frame = [self.INITIALISE, sequence_num & 0xff, self.checksum.id, self.sequence_bytes]
+                    frame += list((sequence_num >> 8).to_bytes(self.sequence_bytes - 1, 'little'))
                     if self.verbose > 0:
                         print(self.id, dst, "Send init", frame)
-                    self.tx_direct_buffer.add_frame(self.id, dst, frame)
+                    self.tx_direct_buffer.add_frame(self.id, dst, frame, DEFAULT_CHECKSUM)
         bytes_left = self.writer.max_bytes
         # First transmit direct frames/responses (not too many otherwise one side gets all the bandwidth)
         bytes_left -= self.__tx_responses(bytes_left/2)
@@ -237,95 +685,360 @@ class WindowedProtocol:
         bytes_left -= self.__tx_requests(bytes_left)
         # Now if there is any space left try and fit in more direct frames/responses
         bytes_left -= self.__tx_responses(bytes_left)
+
+    # The clock time process_tx next has something to do if nothing is received or submitted before then,
+    # or None if it's idle. Lets an event loop sleep between timers instead of calling process_tx on a fixed tick
+    def next_tx_time(self):
+        now = self.clock.time()
+        times = [time + self.ACK_DELAY for time in self.pending_acks.values()]
+        if len(self.tx_direct_buffer.frames) > 0:
+            times.append(now)
+        for dst in self.tx_windows:
+            if not self.egress_initialised[dst]:
+                # Retry the init request if there's no response
+                times.append(now + self.rto[dst])
+            elif self.tx_windows[dst].num_frames() > 0:
+                if self.time_end_reached[dst] == None:
+                    times.append(now)
+                else:
+                    times.append(self.time_end_reached[dst] + self.rto[dst])
+        if len(times) == 0:
+            return None
+        return min(times)
+
+    # How many bytes of payload one more frame to dst could have (0 if it's full)
+    def tx_space(self, dst):
+        free_space = self.tx_windows[dst].free_space()
+        # The frame type and sequence number are added to the payload, and COBS can add a byte every 254
+        overhead = 1 + self.tx_sequence_bytes[dst]
+        length = free_space - max_frame_length(overhead, self.tx_checksum[dst])
+        length -= length // 254
+        while length > 0 and max_frame_length(length + overhead, self.tx_checksum[dst]) > free_space:
+            length -= 1
+        return max(length, 0)
     
-    # Returns number of frames successfully submitted
+    # Returns number of frames successfully submitted, the rest can be submitted again once there is room
+    # (see tx_space and on_tx_space)
     def submit_tx_frames(self, dst, frames):
+        return self.submit_many(dst, frames)
+    
+    # frames can be any sequence of frames (list, deque, tuple...), each a list of ints or any buffer protocol object
+    # (see frame_bytes). The header, payload and sequence number are encoded straight into the window's buffer so
+    # the payload is only copied once, and the caller can reuse its buffers as soon as this returns.
+    # Returns the number submitted like submit_tx_frames, the rest are still in frames[num_submitted:]. An iterator
+    # isn't accepted as the frame that didn't fit would have been taken from it and lost
+    def submit_many(self, dst, frames):
+        if iter(frames) is frames:
+            raise TypeError('frames must be a sequence, not an iterator')
         # Only allow frames to be sent once all connections are initialised
         # So we don't block any init requests with data
-        for initialised in self.egress_initialised:
+        for initialised in self.egress_initialised.values():
             if not initialised:
                 return 0
+        window = self.tx_windows[dst]
+        checksum = self.tx_checksum[dst]
+        sequence_bytes = self.tx_sequence_bytes[dst]
+        modulus = self.__tx_modulus(dst)
+        num_submitted = 0
+        for bare_frame in frames:
+            bare_frame = frame_bytes(bare_frame)
+            if self.aggregate and self.__add_to_aggregate(dst, bare_frame):
+                num_submitted += 1
+                continue
+            sequence_num = self.tx_sequence_num[dst]
+            parts = [self.FRAME_HEADER, bare_frame, sequence_num.to_bytes(sequence_bytes, 'little')]
+            if not window.add_frame_parts(self.id, dst, sequence_num, parts, checksum):
+                self.tx_full.add(dst)
+                break
+            if self.aggregate:
+                if len(bare_frame) < self.AGGREGATE_SIZE:
+                    self.tx_aggregate[dst] = (sequence_num, [bytes(bare_frame)])
+                else:
+                    self.tx_aggregate.pop(dst, None)
+            self.tx_sequence_num[dst] = (sequence_num + 1) % modulus
+            num_submitted += 1
         if self.verbose > 0:
-            print(self.id, dst, "Submitting", len(frames), "frames")
+            print(self.id, dst, "Submitted", num_submitted, "frames")
+        return num_submitted
+    
+    def __tx_sequence(self, dst, sequence_num):
+        return sequence_num.to_bytes(self.tx_sequence_bytes[dst], 'little')
+    
+    def __aggregate_frame(self, dst, id, frames):
+        frame = bytearray([self.AGGREGATE])
         for bare_frame in frames:
-            frame = bare_frame.copy()
-            frame.insert(0, self.FRAME)
-            frame.append(self.tx_sequence_num[dst])
-            self.tx_window_buffer.add_frame(self.id, dst, self.tx_sequence_num[dst], frame)
-            self.tx_sequence_num[dst] = (self.tx_sequence_num[dst] + 1) % 256
-        return len(frames)
+            frame.append(len(bare_frame))
+            frame.extend(bare_frame)
+        return frame + self.__tx_sequence(dst, id)
+    
+    # Re-encode the newest frame to dst with this frame added to it, if it hasn't been sent and it'll fit.
+    # Returns False if the frame needs to go on its own
+    def __add_to_aggregate(self, dst, bare_frame):
+        if dst not in self.tx_aggregate:
+            return False
+        (id, frames) = self.tx_aggregate[dst]
+        size = sum([1 + len(frame) for frame in frames]) + 1 + len(bare_frame)
+        if len(bare_frame) > 0xff or size > self.AGGREGATE_SIZE:
+            return False
+        window = self.tx_windows[dst]
+        if not window.pop_last_unsent(id):
+            del self.tx_aggregate[dst]
+            return False
+        if window.add_frame(self.id, dst, id, self.__aggregate_frame(dst, id, frames + [bare_frame]), self.tx_checksum[dst]):
+            frames.append(bytes(bare_frame))
+            return True
+        # No room for the bigger frame, put back the one that was there
+        if len(frames) == 1:
+            parts = [self.FRAME_HEADER, frames[0], self.__tx_sequence(dst, id)]
+        else:
+            parts = [self.__aggregate_frame(dst, id, frames)]
+        window.add_frame_parts(self.id, dst, id, parts, self.tx_checksum[dst])
+        return False
         
+    # Bit i is set if the frame i+1 after the next expected one has been received
+    # Only as many bytes as needed, so nothing if there are no frames out of order
+    def __sack_bitmap(self, src):
+        bitmap = 0
+        for sequence_num in self.rx_out_of_order[src]:
+            bitmap |= 1 << (sequence_distance(self.exp_rx_sequence_num[src], sequence_num, self.__rx_modulus(src)) - 1)
+        return list(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little'))
+    
+    # Frames held out of order only count against other frames arriving out of order, otherwise they could
+    # take all the room and the frame that releases them would be dropped.
+    # RX_QUEUE_FRAMES closes the advertised window, but the sender may have a whole window of frames in flight
+    # by the time it hears, so up to that many more are still taken in_flight rather than dropped and resent
+    def __rx_window(self, src, out_of_order=False, in_flight=False):
+        max_frames = self.RX_QUEUE_FRAMES
+        if in_flight:
+            max_frames += self.__window_size(self.__rx_modulus(src))
+        if len(self.rx_frames[src]) >= max_frames:
+            return 0
+        num_bytes = self.rx_buffered[src]
+        if not out_of_order:
+            num_bytes -= self.rx_out_of_order_bytes[src]
+        return max(self.RX_BUFFER_SIZE - num_bytes, 0)
+    
+    # [ACK, last sequence num received in order (sequence bytes), room left (2 bytes),
+    #  selective ack bitmap (selective repeat only)]
+    def __ack(self, src):
+        rx_window = min(self.__rx_window(src), 0xffff)
+        self.advertised_rx_window[src] = rx_window
+        sequence_num = (self.exp_rx_sequence_num[src] - 1) % self.__rx_modulus(src)
+        response = [self.ACK] + list(sequence_num.to_bytes(self.rx_sequence_bytes[src], 'little'))
+        response += list(rx_window.to_bytes(2, 'little'))
+        if self.selective_repeat:
+            response += self.__sack_bitmap(src)
+        return response
+    
+    def __send_ack(self, src):
+        self.pending_acks.pop(src, None)
+        self.num_acks_sent += 1
+        self.tx_direct_buffer.add_frame(self.id, src, self.__ack(src), self.tx_checksum[src])
+    
+    def __queue_ack(self, src):
+        if self.ACK_DELAY == None:
+            self.__send_ack(src)
+        elif src not in self.pending_acks:
+            self.pending_acks[src] = self.clock.time()
+    
+    # Send the ACKs that have waited long enough. The ACK is made when it's sent so it covers everything received
+    def __send_acks(self):
+        now = self.clock.time()
+        for (src, time) in list(self.pending_acks.items()):
+            if now >= time + self.ACK_DELAY:
+                self.__send_ack(src)
+    
+    def __deliver(self, src, type, data):
+        if type == self.AGGREGATE:
+            pos = 0
+            while pos < len(data):
+                length = data[pos]
+                frame = data[pos+1:pos+1+length]
+                if len(frame) != length:
+                    # Can only happen if the sender got it wrong - the checksum has passed
+                    break
+                self.__deliver_frame(src, frame)
+                pos += 1 + length
+        else:
+            self.__deliver_frame(src, data)
+    
+    def __deliver_frame(self, src, frame):
+        if self.on_frame != None:
+            self.on_frame(src, frame)
+        else:
+            self.rx_frames[src].append(frame)
+            self.rx_buffered[src] += len(frame)
+    
     def __handle_request(self, src, type, data):
         if self.verbose > 1:
             print(self.id, src, "Incoming frame:", data)
         response = None
-        if type == self.FRAME:
+        if type == self.FRAME or type == self.AGGREGATE:
             if self.ingress_initialised[src]:
-                sequence_num = data.pop(-1)
+                num_bytes = self.rx_sequence_bytes[src]
+                # Frames too short for their type can only be corruption that got past a weak checksum
+                if len(data) < num_bytes:
+                    return
+                modulus = self.__rx_modulus(src)
+                sequence_num = int.from_bytes(data[-num_bytes:], 'little')
+                data = data[:-num_bytes]
                 if self.verbose > 0:
                     print(self.id, src, "Received frame - seq", sequence_num)
-                if sequence_num == self.exp_rx_sequence_num[src]:
-                    response = [self.ACK, sequence_num]
-                    self.exp_rx_sequence_num[src] = (sequence_num + 1) % 256
-                    self.rx_frames[src].append(data)
+                # If there's no room the frame is dropped, the sender will try again once we say there is.
+                # A frame bigger than the whole buffer is let in when it's next and nothing is waiting to be taken,
+                # otherwise it could never be delivered
+                in_order = sequence_num == self.exp_rx_sequence_num[src]
+                rx_window = self.__rx_window(src, not in_order, True)
+                room = (0 < rx_window and len(data) <= rx_window) or (in_order and len(self.rx_frames[src]) == 0)
+                if not room:
+                    pass
+                elif in_order:
+                    self.exp_rx_sequence_num[src] = (sequence_num + 1) % modulus
+                    self.__deliver(src, type, data)
+                    # Pass on any frames after this one that arrived early
+                    out_of_order = self.rx_out_of_order[src]
+                    while self.exp_rx_sequence_num[src] in out_of_order:
+                        (early_type, early_data) = out_of_order.pop(self.exp_rx_sequence_num[src])
+                        self.rx_buffered[src] -= len(early_data)
+                        self.rx_out_of_order_bytes[src] -= len(early_data)
+                        self.__deliver(src, early_type, early_data)
+                        self.exp_rx_sequence_num[src] = (self.exp_rx_sequence_num[src] + 1) % modulus
+                elif (self.selective_repeat and
+                      0 < sequence_distance(self.exp_rx_sequence_num[src], sequence_num, modulus) < self.__window_size(modulus)):
+                    if sequence_num not in self.rx_out_of_order[src]:
+                        self.rx_out_of_order[src][sequence_num] = (type, data)
+                        self.rx_buffered[src] += len(data)
+                        self.rx_out_of_order_bytes[src] += len(data)
                 else:
-                    response = [self.ACK, (self.exp_rx_sequence_num[src] - 1) % 256]
                     # Invalid sequence num
                     pass
+                self.__queue_ack(src)
             else:
                 response = [self.UNINITIALISED, 0]
                 if self.verbose > 0:
                     print(self.id, src, "Response uninit")
         elif type == self.INITIALISE:
-            self.exp_rx_sequence_num[src] = data[0]
+            # Use the sequence number size the other side asked for if we support it, otherwise 1 byte
+            sequence_bytes = 1
+            if len(data) > 2 and data[2] in self.SEQUENCE_BYTES:
+                sequence_bytes = data[2]
+            if len(data) < 1 or (sequence_bytes > 1 and len(data) < 2 + sequence_bytes):
+                return
+            self.rx_sequence_bytes[src] = sequence_bytes
+            sequence_num = data[0] | (int.from_bytes(data[3:3+sequence_bytes-1], 'little') << 8)
+            self.exp_rx_sequence_num[src] = sequence_num % self.__rx_modulus(src)
+            self.rx_buffered[src] -= self.rx_out_of_order_bytes[src]
+            self.rx_out_of_order[src] = {}
+            self.rx_out_of_order_bytes[src] = 0
             self.ingress_initialised[src] = True
-            response = [self.INITIALISED, 0]
+            # Use the checksum the other side asked for if we support it, otherwise stay on the default
+            checksum = DEFAULT_CHECKSUM
+            if len(data) > 1:
+                try:
+                    checksum = crc.get_checksum(data[1])
+                except KeyError:
+                    pass
+            self.rx_checksum[src] = checksum
+            response = [self.INITIALISED, checksum.id, sequence_bytes]
             if self.verbose > 0:
                 print(self.id, src, "Response init", response)
-        else:
-            print("Invalid request type")
-            assert 0
+        elif self.verbose > 0:
+            # Only possible with a weak checksum that let a corrupted frame through
+            print(self.id, src, "Invalid request type", type)
         if response != None:
-            assert len(response) == 2
-            self.tx_direct_buffer.add_frame(self.id, src, response)
+            assert len(response) >= 2
+            self.tx_direct_buffer.add_frame(self.id, src, response, DEFAULT_CHECKSUM)
     
     def __handle_response(self, src, type, data):
         if type == self.ACK:
+            num_bytes = self.tx_sequence_bytes[src]
+            if len(data) < num_bytes + 2:
+                return
+            sequence_num = int.from_bytes(data[:num_bytes], 'little')
             if self.verbose > 0:
-                print(self.id, src, "Received ack", data[0])
-            self.tx_window_buffer.ack_frame(src, data[0])
+                print(self.id, src, "Received ack", sequence_num)
+            num_frames = self.tx_windows[src].num_frames()
+            send_time = self.tx_windows[src].ack_frame(src, sequence_num)
+            if send_time != None:
+                self.__update_rto(src, self.clock.time() - send_time)
+            if self.tx_windows[src].num_frames() != num_frames:
+                # Something new was acked so restart the timer
+                self.time_end_reached[src] = None
+                self.__reset_rto(src)
+                if src in self.tx_full:
+                    self.tx_full.remove(src)
+                    if self.on_tx_space != None:
+                        self.on_tx_space(src)
+            # Don't send more than the other side has room for
+            rx_window = data[num_bytes] | (data[num_bytes+1] << 8)
+            self.tx_windows[src].window_bytes = min(rx_window, self.WINDOW_BYTES)
+            if len(data) > num_bytes + 2:
+                # Selective ack - bit i is for the frame i+2 after the acked one
+                bitmap = int.from_bytes(data[num_bytes+2:], 'little')
+                modulus = self.__tx_modulus(src)
+                ids = [(sequence_num + 2 + i) % modulus for i in range(bitmap.bit_length()) if (bitmap >> i) & 1]
+                self.tx_windows[src].sack_frames(src, ids)
         elif type == self.UNINITIALISED:
             if self.egress_initialised[src]:
                 self.egress_initialised[src] = False
+                self.tx_checksum[src] = DEFAULT_CHECKSUM
         elif type == self.INITIALISED:
+            if len(data) < 1:
+                return
             self.egress_initialised[src] = True
-        else:
-            print("Invalid response type")
-            assert 0
+            # The other side tells us which checksum it accepted
+            try:
+                self.tx_checksum[src] = crc.get_checksum(data[0])
+            except KeyError:
+                self.tx_checksum[src] = DEFAULT_CHECKSUM
+            # And which sequence number size
+            self.tx_sequence_bytes[src] = data[1] if len(data) > 1 and data[1] in self.SEQUENCE_BYTES else 1
+            self.tx_sequence_num[src] %= self.__tx_modulus(src)
+            self.tx_windows[src].window_size = self.__window_size(self.__tx_modulus(src))
+        elif self.verbose > 0:
+            print(self.id, src, "Invalid response type", type)
     
     def __handle_rx_frame(self, src, frame):
-        frame_type = frame.pop(0)
-        frame_data = frame
+        frame_type = frame[0]
+        frame_data = frame[1:]
         if (frame_type & 0x80) == 0x80:
             self.__handle_response(src, frame_type, frame_data)
         else:
             self.__handle_request(src, frame_type, frame_data)
     
     def process_rx(self):
-        self.rx_bytes += self.reader.read()
-        while True:
-            # if self.verbose:
-            #     print(self.id, "rx bytes frame:", self.rx_bytes)
-            (src, dst, frame) = decode_frame(self.rx_bytes)
-            if frame == None:
-                break
-            if dst == self.id:
+        for (src, dst, frame) in self.rx_decoder.feed(self.reader.read()):
+            # A src we aren't connected to can only be corruption that got past a weak checksum
+            if dst == self.id and src in self.ingress_initialised:
                 self.__handle_rx_frame(src, frame)
+        self.__send_acks()
     
+    # Frames are returned (in a deque) as memoryviews onto the received data
     def get_rx_frames(self, src):
-        frames = self.rx_frames[src][:]
-        self.rx_frames[src] = []
+        frames = self.rx_frames[src]
+        self.rx_frames[src] = deque()
+        self.__rx_frames_taken(src, sum([len(frame) for frame in frames]))
         return frames
+    
+    # Yields (src, frame) until there are no frames waiting, taking one frame from each source in turn
+    # so a busy source can't hold up the others
+    def receive_frames(self):
+        waiting = True
+        while waiting:
+            waiting = False
+            for (src, frames) in self.rx_frames.items():
+                if len(frames) > 0:
+                    frame = frames.popleft()
+                    self.__rx_frames_taken(src, len(frame))
+                    waiting = True
+                    yield (src, frame)
+    
+    def __rx_frames_taken(self, src, num_bytes):
+        self.rx_buffered[src] -= num_bytes
+        # If the source was told we were getting full let it know there's room again,
+        # otherwise it would have to wait for the timeout to probe
+        if self.advertised_rx_window[src] < self.RX_BUFFER_SIZE // 2 <= self.__rx_window(src):
+            self.__send_ack(src)
             
     
 ##########################
@@ -335,22 +1048,26 @@ class TestWriter:
     def __init__(self, all_connected_readers):
         self.readers = all_connected_readers
         self.max_bytes = 1000 # Send up to this many bytes at a time
+        self.corruption_rate = 1/20 # Chance of a byte being zeroed in each write
+        self.num_bytes = 0 # Written so far
         
     def write(self, data):
+        self.num_bytes += len(data)
         for reader in self.readers:
+            rx_data = bytearray(data)
             # Corruption
-            if random.random() < 1/20:
-                index = random.randint(0, len(data)-1)
-                data[index] = 0
-            reader.buffer = reader.buffer + data
+            if random.random() < self.corruption_rate:
+                index = random.randint(0, len(rx_data)-1)
+                rx_data[index] = 0
+            reader.buffer += rx_data
 
 class TestReader:
     def __init__(self):
-        self.buffer = []
+        self.buffer = bytearray()
     
     def read(self):
-        data = self.buffer[:]
-        self.buffer = []
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
         return data
 
 class TestBench:
@@ -360,9 +1077,13 @@ class TestBench:
     
     def __init__(self):
         self.nodes = []
+        self.disconnected = set()
+        # Each node takes its received frames after processing, like an application would, unless it's paused
+        self.received = [] # [{src: [frame]}]
+        self.paused = set()
         self.clock = test_node.Clock(0, 0, self.ticks_per_sec)
     
-    def create_nodes(self, num):
+    def create_nodes(self, num, checksums=['crc16'], selective_repeat=False, aggregate=False, sequence_bytes=[1]):
         readers = []
         ids = []
         for i in range(num):
@@ -375,8 +1096,10 @@ class TestBench:
             connected_ids = ids[:]
             connected_ids.pop(i)
             writer = TestWriter(connected_readers)
-            protocol = WindowedProtocol(i, self.clock, connected_ids, writer, readers[i])
+            protocol = WindowedProtocol(i, self.clock, connected_ids, writer, readers[i], checksums[i % len(checksums)],
+                                        selective_repeat, aggregate, sequence_bytes[i % len(sequence_bytes)])
             self.nodes.append(protocol)
+            self.received.append(dict([(id, []) for id in connected_ids]))
             
     
     def run_till_initialised(self, max_ticks):
@@ -398,27 +1121,52 @@ class TestBench:
             print("Failed to initialise")
             assert 0
     
+    # The node stops processing and everything sent to it is lost, as if it had been unplugged
+    def disconnect(self, id):
+        self.disconnected.add(id)
+    
+    def process_nodes(self):
+        for node in self.nodes:
+            if node.id in self.disconnected:
+                node.reader.buffer = bytearray()
+            else:
+                node.process_rx()
+                node.process_tx()
+                if node.id not in self.paused:
+                    for (src, frames) in self.received[node.id].items():
+                        frames += node.get_rx_frames(src)
+    
+    # Payload bytes taken by all the nodes so far
+    def rx_bytes(self):
+        total = 0
+        for received in self.received:
+            for frames in received.values():
+                total += sum([len(frame) for frame in frames])
+        return total
+    
+    def run_for(self, ticks):
+        for tick in range(ticks):
+            self.clock.incr_ticks(1)
+            if tick % self.ticks_betwen_processes == 0:
+                self.process_nodes()
+    
     def run(self, total_num_frames, max_ticks):
         for tick in range(max_ticks):
             self.clock.incr_ticks(1)
             if tick % self.ticks_betwen_processes == 0:
+                self.process_nodes()
                 sum = 0
-                for rx in range(len(self.nodes)):
-                    node = self.nodes[rx]
-                    node.process_rx()
-                    node.process_tx()
-                    for tx in range(len(self.nodes)):
-                        if tx != node.id:
-                            sum += len(node.rx_frames[tx])
+                for received in self.received:
+                    for frames in received.values():
+                        sum += len(frames)
                 if sum == total_num_frames:
                     return True
         return False
 
-def basic_test():
+# Send frames from every node to every other node and check they all arrive in order
+def transfer_test(num_nodes, num_frames, max_frame_length, checksums=['crc16'], selective_repeat=False, aggregate=False,
+                  sequence_bytes=[1]):
     # Create frames
-    num_nodes = 5
-    num_frames = 100
-    max_frame_length = 240
     frames_from_to = [[[] for i in range(num_nodes)] for i in range(num_nodes)]
     for tx in range(num_nodes):
         for rx in range(num_nodes):
@@ -429,7 +1177,7 @@ def basic_test():
     
     # Run tests
     test = TestBench()
-    test.create_nodes(num_nodes)
+    test.create_nodes(num_nodes, checksums, selective_repeat, aggregate, sequence_bytes)
     test.run_till_initialised(10000)
     num_frames = 0
     for tx in range(num_nodes):
@@ -446,20 +1194,525 @@ def basic_test():
     for tx in range(num_nodes):
         for rx in range(num_nodes):
             if rx != tx:
-                got = test.nodes[rx].get_rx_frames(tx)
+                got = test.received[rx][tx]
                 exp = frames_from_to[tx][rx]
                 print("Frames from", tx, "to", rx, ":", len(got))
                 for i in range(len(exp)):
-                    if got[i] != exp[i]:
+                    if bytes(got[i]) != bytes(exp[i]):
                         print("Tx", tx, "Rx", rx, "Frame", i, "- did not match")
                         print("Tx", exp[i])
                         print("Rx", got[i])
                         assert 0
+    return test
+
+def basic_test():
+    transfer_test(5, 100, 240)
+
+def selective_repeat_test():
+    transfer_test(5, 100, 240, selective_repeat=True)
+
+def sack_frames_test():
+    buffer = SlidingWindowByteBuffer(10**6, 4, 0)
+    frames = [[i] for i in range(6)]
+    buffer.add_frames(0, 1, list(range(6)), frames)
+    encoded = [encode_frame(0, 1, frame) for frame in frames]
+    assert buffer.get_next_frames(10**6) == b''.join(encoded[:4])
+    # Frames outside the window or not queued are ignored
+    buffer.sack_frames(1, [1, 3, 4, 9])
+    assert buffer.sacked == set([1, 3])
+    # The window is re-sent without the acked frames
+    assert buffer.get_next_frames(10**6) == encoded[0] + encoded[2]
+    buffer.ack_frame(1, 1)
+    assert buffer.sacked == set([3])
+    # Carries on from where it got to then wraps
+    assert buffer.get_next_frames(10**6) == encoded[4] + encoded[5]
+    assert buffer.get_next_frames(10**6) == encoded[2] + encoded[4] + encoded[5]
+    buffer.ack_frame(1, 5)
+    assert buffer.num_frames() == 0
+    assert len(buffer.sacked) == 0
+
+def rtt_test():
+    buffer = SlidingWindowByteBuffer(10**6, 2, 0)
+    buffer.add_frames(0, 1, [0, 1, 2], [[0], [1], [2]])
+    buffer.get_next_frames(10**6, 0.5)
+    assert buffer.ack_frame(1, 0) == 0.5
+    buffer.get_next_frames(10**6, 0.75)
+    # Wrap and send 1 and 2 again, so an ack could be for either send
+    buffer.get_next_frames(10**6, 1.0)
+    assert buffer.num_retransmissions == 2
+    assert buffer.ack_frame(1, 1) == None
+    buffer.add_frame(0, 1, 3, [3])
+    buffer.get_next_frames(10**6, 1.25)
+    assert buffer.ack_frame(1, 3) == 1.25
+    assert len(buffer.send_times) == 0 and len(buffer.resent) == 0
+    # The protocol's estimates should settle somewhere near how often the nodes are processed
+    test = transfer_test(3, 50, 240)
+    period = test.ticks_betwen_processes / test.ticks_per_sec
+    for node in test.nodes:
+        for dst in node.rto:
+            assert period / 2 < node.srtt[dst] < 10 * period
+            assert WindowedProtocol.MIN_RTO <= node.rto[dst] <= WindowedProtocol.MAX_RTO
+    # After backing off while the other side was unreachable, the timeout comes back down as soon as acks
+    # release frames, even though they are all retransmissions
+    test.disconnect(1)
+    frames = [[random.randint(0,255) for i in range(100)] for f in range(5)]
+    test.nodes[0].submit_tx_frames(1, frames)
+    test.run_for(1000000)
+    assert test.nodes[0].rto[1] > 100 * period
+    test.disconnected.remove(1)
+    assert test.run(6 * 50 + len(frames), 10000000)
+    # The ack can be lost, then it takes another retransmission
+    for i in range(300):
+        if test.nodes[0].tx_windows[1].num_frames() == 0:
+            break
+        test.run_for(10000)
+    assert test.nodes[0].tx_windows[1].num_frames() == 0
+    assert test.nodes[0].rto[1] < 10 * period
+
+# A node that doesn't take its frames shouldn't be sent more than it has room for
+def flow_control_test():
+    test = TestBench()
+    test.create_nodes(2)
+    test.run_till_initialised(10000)
+    test.paused.add(1)
+    (sender, receiver) = test.nodes
+    frames = [[random.randint(0,255) for i in range(100)] for f in range(300)]
+    assert sender.submit_tx_frames(1, frames) == len(frames)
+    test.run_for(100000)
+    assert 0 < receiver.rx_buffered[0] <= receiver.RX_BUFFER_SIZE
+    assert len(receiver.rx_frames[0]) < len(frames)
+    assert sender.tx_windows[1].window_bytes < 100
+    # Once it starts taking them again the rest should come through
+    test.paused.remove(1)
+    assert test.run(len(frames), 10000000)
+    assert [bytes(frame) for frame in test.received[1][0]] == [bytes(frame) for frame in frames]
+
+# A frame bigger than the receive buffer still gets through, along with the frames behind it
+def large_frame_test():
+    test = TestBench()
+    test.create_nodes(2)
+    for node in test.nodes:
+        node.writer.max_bytes = 20000
+    test.run_till_initialised(10000)
+    (sender, receiver) = test.nodes
+    frames = [[random.randint(0,255) for i in range(100)], [random.randint(0,255) for i in range(9000)]]
+    frames += [[random.randint(0,255) for i in range(100)] for f in range(10)]
+    assert receiver.RX_BUFFER_SIZE < 9000
+    assert sender.submit_tx_frames(1, frames) == len(frames)
+    assert test.run(len(frames), 10000000)
+    assert [bytes(frame) for frame in test.received[1][0]] == [bytes(frame) for frame in frames]
+
+def receive_delivery_test():
+    # Frames handed straight to a callback aren't buffered at all
+    test = TestBench()
+    test.create_nodes(3)
+    test.run_till_initialised(10000)
+    delivered = {0: [], 1: []}
+    receiver = test.nodes[2]
+    receiver.on_frame = lambda src, frame: delivered[src].append(bytes(frame))
+    frames = [[bytes([random.randint(0,255) for i in range(random.randint(0, 50))]) for f in range(100)] for tx in range(2)]
+    for tx in range(2):
+        assert test.nodes[tx].submit_many(2, frames[tx]) == len(frames[tx])
+    for i in range(1000):
+        test.run_for(test.ticks_betwen_processes)
+        assert receiver.rx_buffered[0] == receiver.rx_buffered[1] == 0
+    assert delivered[0] == frames[0] and delivered[1] == frames[1]
+    # One iterator takes the waiting frames from all the sources in turn
+    receiver.on_frame = None
+    test.paused.add(2)
+    for tx in range(2):
+        assert test.nodes[tx].submit_many(2, frames[tx][:20]) == 20
+    test.run_for(10000)
+    received = list(receiver.receive_frames())
+    assert [src for (src, frame) in received[:4]] == [0, 1, 0, 1]
+    for tx in range(2):
+        assert [bytes(frame) for (src, frame) in received if src == tx] == frames[tx][:20]
+    assert receiver.rx_buffered[0] == receiver.rx_buffered[1] == 0
+    # Lots of tiny frames only queue up to RX_QUEUE_FRAMES, then the window closes,
+    # past the frames that were already in flight
+    frames = [b''] * (3 * receiver.RX_QUEUE_FRAMES)
+    assert test.nodes[0].submit_many(2, frames) == len(frames)
+    test.run_for(100000)
+    assert 0 < len(receiver.rx_frames[0]) <= receiver.RX_QUEUE_FRAMES + test.nodes[0].tx_windows[2].window_size
+    assert len(receiver.rx_frames[0]) < len(frames)
+    test.paused.remove(2)
+    assert test.run(len(frames), 10000000)
+    # A window of more than RX_QUEUE_FRAMES isn't held up by the queue closing. The frames already in flight
+    # are taken rather than dropped, and frames held out of order don't close the window
+    test = TestBench()
+    test.create_nodes(2, sequence_bytes=[2], selective_repeat=True)
+    for node in test.nodes:
+        node.WINDOW_SIZE = 2000
+        node.WINDOW_BYTES = node.RX_BUFFER_SIZE = 60000
+        node.writer.max_bytes = 10000
+        node.writer.corruption_rate = 1/100
+    test.run_till_initialised(10000)
+    frames = [bytes([random.randint(0,255) for i in range(16)]) for f in range(3000)]
+    assert test.nodes[0].submit_tx_frames(1, frames) == len(frames)
+    assert test.run(len(frames), 200000)
+    assert [bytes(frame) for frame in test.received[1][0]] == frames
+
+def ring_buffer_test():
+    ring = RingBuffer(100)
+    assert ring.free_space() == 100
+    for length in [40, 40]:
+        offset = ring.reserve(length)
+        ring.buffer[offset:offset+length] = bytes([length]) * length
+        ring.push(offset, length)
+    assert ring.reserve(30) == None and ring.free_space() == 20
+    ring.pop()
+    # Doesn't fit in the 20 bytes at the end so goes at the start
+    assert ring.reserve(30) == 0
+    ring.push(0, 30)
+    assert ring.free_space() == 10 and ring.num_bytes == 70
+    assert ring.reserve(10) == 30 and ring.reserve(11) == None
+    ring.pop()
+    assert ring.free_space() == 70
+    ring.pop()
+    assert len(ring) == 0 and ring.num_bytes == 0 and ring.reserve(100) == 0
+    # Frames wrap around and come out intact however full it gets
+    buffer = ByteBuffer(1000)
+    sent = []
+    got = b''
+    for i in range(200):
+        frame = [random.randint(0,255) for i in range(random.randint(1, 100))]
+        if buffer.add_frame(1, 2, frame):
+            sent.append(encode_frame(1, 2, frame))
+        else:
+            assert buffer.free_space() < max_frame_length(len(frame))
+        if random.random() < 0.4:
+            got += buffer.pop_next_frames(random.randint(0, 500)) or b''
+    got += buffer.pop_next_frames(1000) or b''
+    assert got == b''.join(sent)
+
+# Frames that don't fit are handed back instead of being lost
+def tx_backpressure_test():
+    test = TestBench()
+    test.create_nodes(2)
+    test.run_till_initialised(10000)
+    (sender, receiver) = test.nodes
+    sender.tx_windows[1] = SlidingWindowByteBuffer(5000, sender.WINDOW_SIZE, 0, sender.WINDOW_BYTES)
+    space_for = []
+    sender.on_tx_space = space_for.append
+    frames = [[random.randint(0,255) for i in range(100)] for f in range(200)]
+    num_submitted = sender.submit_tx_frames(1, frames)
+    assert 0 < num_submitted < len(frames)
+    assert sender.tx_space(1) < 100
+    # A frame that just fits is accepted
+    frames.insert(num_submitted, [0] * sender.tx_space(1))
+    assert sender.submit_tx_frames(1, frames[num_submitted:]) == 1
+    num_submitted += 1
+    assert sender.tx_space(1) == 0
+    # Keep submitting the rest whenever there's room
+    while num_submitted < len(frames):
+        test.run_for(test.ticks_betwen_processes)
+        if len(space_for) > 0:
+            space_for.clear()
+            num_submitted += sender.submit_tx_frames(1, frames[num_submitted:])
+    assert test.run(len(frames), 10000000)
+    assert [bytes(frame) for frame in test.received[1][0]] == [bytes(frame) for frame in frames]
+
+def ack_coalescing_test():
+    num_acks = []
+    for ack_delay in [None, 0, 0.0005]:
+        test = TestBench()
+        test.create_nodes(2)
+        for node in test.nodes:
+            node.ACK_DELAY = ack_delay
+        test.run_till_initialised(10000)
+        frames = [[random.randint(0,255) for i in range(8)] for f in range(500)]
+        assert test.nodes[0].submit_tx_frames(1, frames) == len(frames)
+        assert test.run(len(frames), 10000000)
+        assert [bytes(frame) for frame in test.received[1][0]] == [bytes(frame) for frame in frames]
+        num_acks.append(test.nodes[1].num_acks_sent)
+    # One for every frame received (including repeats), otherwise far fewer. With so few the delay makes
+    # little difference as corruption varies from run to run
+    assert num_acks[0] >= len(frames)
+    assert num_acks[1] < len(frames) / 4
+    assert num_acks[2] < len(frames) / 4
+
+def aggregate_test():
+    # A mix of sizes, some too big to be packed together
+    transfer_test(3, 200, 100, aggregate=True, selective_repeat=True)
+    # Frames submitted one at a time are added to the last one while it's waiting to be sent
+    test = TestBench()
+    test.create_nodes(2, aggregate=True)
+    test.run_till_initialised(10000)
+    sender = test.nodes[0]
+    frames = [[random.randint(0,255) for i in range(random.randint(0, 16))] for f in range(200)]
+    for frame in frames:
+        assert sender.submit_tx_frames(1, [frame]) == 1
+    assert sender.tx_windows[1].num_frames() < len(frames) / 4
+    assert test.run(len(frames), 10000000)
+    assert [bytes(frame) for frame in test.received[1][0]] == [bytes(frame) for frame in frames]
+
+def sequence_bytes_test():
+    # Each link uses the sequence number size its sender asked for, and wraps with it
+    sequence_bytes = [1, 2]
+    for selective_repeat in [False, True]:
+        test = transfer_test(3, 300, 20, selective_repeat=selective_repeat, sequence_bytes=sequence_bytes)
+        for tx in range(3):
+            for rx in range(3):
+                if rx != tx:
+                    assert test.nodes[tx].tx_sequence_bytes[rx] == sequence_bytes[tx % 2]
+                    assert test.nodes[rx].rx_sequence_bytes[tx] == sequence_bytes[tx % 2]
+    # A node that only has 1 byte sequence numbers turns down 2
+    test = TestBench()
+    test.create_nodes(2, sequence_bytes=[2])
+    test.nodes[1].SEQUENCE_BYTES = (1,)
+    test.run_till_initialised(10000)
+    assert test.nodes[0].tx_sequence_bytes[1] == 1 and test.nodes[1].rx_sequence_bytes[0] == 1
+    assert test.nodes[0].tx_windows[1].window_size <= 128
+    # 2 bytes allow more than 256 frames in flight
+    test = TestBench()
+    test.create_nodes(2, sequence_bytes=[2], selective_repeat=True)
+    for node in test.nodes:
+        node.WINDOW_SIZE = 1000
+        node.WINDOW_BYTES = 50000
+        node.RX_BUFFER_SIZE = 50000
+        node.writer.max_bytes = 50000
+        node.writer.corruption_rate = 1/200
+    test.run_till_initialised(10000)
+    assert test.nodes[0].tx_windows[1].window_size == 1000
+    frames = [[random.randint(0,255) for i in range(random.randint(0, 8))] for f in range(2000)]
+    assert test.nodes[0].submit_tx_frames(1, frames) == len(frames)
+    most_in_flight = 0
+    for i in range(100):
+        test.run_for(test.ticks_betwen_processes)
+        most_in_flight = max(most_in_flight, test.nodes[0].tx_windows[1].current_pos)
+    assert most_in_flight > 256
+    assert test.run(len(frames), 10000000)
+    assert [bytes(frame) for frame in test.received[1][0]] == [bytes(frame) for frame in frames]
+
+# Any buffer can be submitted, and the caller's buffers can be reused straight away
+def submit_buffers_test():
+    for aggregate in [False, True]:
+        test = TestBench()
+        test.create_nodes(2, aggregate=aggregate)
+        test.run_till_initialised(10000)
+        sender = test.nodes[0]
+        expected = []
+        sensor_buffer = bytearray(8)
+        for i in range(50):
+            sensor_buffer[:] = bytes([random.randint(0,255) for i in range(8)])
+            expected.append(bytes(sensor_buffer))
+            assert sender.submit_many(1, [sensor_buffer]) == 1
+        samples = array.array('H', [random.randint(0, 0xffff) for i in range(20)])
+        frames = [b'', bytes([1, 2, 3]), memoryview(b'abcdef')[1:4], samples, [4, 5, 6]]
+        expected += [b'', bytes([1, 2, 3]), b'bcd', samples.tobytes(), bytes([4, 5, 6])]
+        try:
+            sender.submit_many(1, iter(frames))
+            assert 0
+        except TypeError:
+            pass
+        assert sender.submit_many(1, frames) == len(frames)
+        assert test.run(len(expected), 10000000)
+        assert [bytes(frame) for frame in test.received[1][0]] == expected
+
+# Every node hears the frames between the other two, but shouldn't decode them
+def address_filter_test():
+    test = transfer_test(3, 50, 240)
+    for node in test.nodes:
+        assert node.stats()['rx_skipped'] >= 2 * 50
+
+def checksum_negotiation_test():
+    checksums = ['crc16', 'crc32c', 'crc8']
+    test = transfer_test(3, 50, 240, checksums)
+    # Each link should be using the checksum the receiving node was asked for by the sender
+    for tx in range(3):
+        for rx in range(3):
+            if rx != tx:
+                assert test.nodes[tx].tx_checksum[rx].name == checksums[tx]
+                assert test.nodes[rx].rx_checksum[tx].name == checksums[tx]
+
+# A corrupted frame on a crc32c link must not get through because our own weaker checksum happens to pass
+def checksum_strength_test():
+    node = WindowedProtocol(0, test_node.Clock(0, 0, 1000), [1], TestWriter([]), TestReader(), 'crc8')
+    crc32c = crc.get_checksum('crc32c')
+    node.rx_checksum[1] = crc32c
+    for i in range(20000):
+        frame = bytes([WindowedProtocol.FRAME] + [random.randint(0,255) for k in range(random.randint(1, 60))])
+        encoded = bytearray(encode_frame(1, 0, frame, crc32c))
+        # Change any byte after the destination, but not the delimiter
+        index = random.randint(2, len(encoded) - 2)
+        encoded[index] = (encoded[index] + random.randint(1, 255)) % 256
+        # The change can make it look like a frame from another node, or an init frame which is only crc16
+        for (src, dst, rx_frame) in node.rx_decoder.feed(encoded):
+            assert src != 1 or rx_frame[0] in WindowedProtocol.INIT_TYPES
+    received = list(node.rx_decoder.feed(encode_frame(1, 0, frame, crc32c)))
+    assert [(src, dst, bytes(rx_frame)) for (src, dst, rx_frame) in received] == [(1, 0, frame)]
+
+# Frames bigger than TX_QUANTUM go out in the first process_tx after they're submitted
+def large_quantum_test():
+    test = TestBench()
+    test.create_nodes(3)
+    test.run_till_initialised(10000)
+    test.run_for(10000)
+    sender = test.nodes[0]
+    for length in [300, 600, 900]:
+        frame = bytes([random.randint(0,255) for i in range(length)])
+        assert sender.submit_many(1, [frame]) == 1
+        num_bytes = sender.writer.num_bytes
+        sender.process_tx()
+        assert sender.writer.num_bytes - num_bytes > length
+        test.run_for(10000)
+        assert sender.num_tx_window_frames() == 0
+
+# Frames too short for their type, or from a node we aren't connected to, can get past a weak checksum.
+# They are dropped instead of taking the node down
+def short_frames_test():
+    test = TestBench()
+    test.create_nodes(2, checksums=['crc8'])
+    test.run_till_initialised(10000)
+    node = test.nodes[0]
+    for type in [WindowedProtocol.FRAME, WindowedProtocol.AGGREGATE, WindowedProtocol.ACK, WindowedProtocol.INITIALISE,
+                 WindowedProtocol.INITIALISED, WindowedProtocol.UNINITIALISED]:
+        checksum = DEFAULT_CHECKSUM if type in WindowedProtocol.INIT_TYPES else node.rx_checksum[1]
+        # Up to 3 bytes of 2s, so an INITIALISE asks for 2 byte sequence numbers without giving one
+        for length in range(4):
+            node.reader.buffer += encode_frame(1, 0, bytes([type] + [2] * length), checksum)
+            node.process_rx()
+    node.reader.buffer += encode_frame(5, 0, bytes([WindowedProtocol.ACK, 0, 0, 0]))
+    node.process_rx()
+    # Lots of corruption on a crc8 link lets some through
+    for node in test.nodes:
+        node.writer.corruption_rate = 1/3
+        for dst in node.tx_windows:
+            node.submit_tx_frames(dst, [[random.randint(0,255) for i in range(random.randint(0, 50))] for f in range(200)])
+    test.run_for(500000)
+
+# However many nodes there are, sending uses the same amount of memory
+def tx_memory_test():
+    for num_nodes in [2, 5, 30]:
+        node = WindowedProtocol(0, test_node.Clock(0, 0, 1000), list(range(1, num_nodes)), TestWriter([]), TestReader())
+        assert sum([len(window.ring.buffer) for window in node.tx_windows.values()]) <= WindowedProtocol.TX_WINDOW_BUFFER_SIZE
+
+# A dead node shouldn't stop the others talking to each other
+def disconnected_peer_test():
+    num_nodes = 4
+    dead = 3
+    test = TestBench()
+    test.create_nodes(num_nodes)
+    test.run_till_initialised(10000)
+    test.disconnect(dead)
+    frames_from_to = {}
+    num_frames = 0
+    for tx in range(num_nodes - 1):
+        for rx in range(num_nodes):
+            if rx != tx:
+                frames = [[random.randint(0,255) for i in range(random.randint(1, 240))] for f in range(50)]
+                frames_from_to[(tx, rx)] = frames
+                assert test.nodes[tx].submit_tx_frames(rx, frames) == len(frames)
+                if rx != dead:
+                    num_frames += len(frames)
+    assert test.run(num_frames, 10000000)
+    test.run_for(10000)
+    for ((tx, rx), frames) in frames_from_to.items():
+        if rx != dead:
+            assert [bytes(frame) for frame in test.received[rx][tx]] == [bytes(frame) for frame in frames]
+        else:
+            # Still waiting to be acked, and backing off
+            assert test.nodes[tx].tx_windows[rx].num_frames() == len(frames)
+            assert test.nodes[tx].rto[rx] > WindowedProtocol.INITIAL_RTO
+
+def frame_decoder_test():
+    frames = []
+    data = []
+    for i in range(50):
+        frame = [random.randint(0,255) for i in range(random.randint(1, 240))]
+        frames.append((i % 7, (i + 1) % 7, frame))
+        data += list(encode_frame(i % 7, (i + 1) % 7, frame))
+        # Add some noise between frames that should be dropped
+        if i % 10 == 0:
+            data += [random.randint(1,255) for i in range(random.randint(0, 20))] + [0]
+    # However the stream is split up we should get the same frames back
+    for max_chunk in [1, 2, 7, 100, len(data)]:
+        decoder = FrameDecoder()
+        got = []
+        pos = 0
+        while pos < len(data):
+            chunk_length = random.randint(1, max_chunk)
+            got += list(decoder.feed(data[pos:pos+chunk_length]))
+            pos += chunk_length
+        assert [(src, dst, list(frame)) for (src, dst, frame) in got] == frames
+        assert len(decoder.buffer) == 0
+    # Only frames for the given addresses are decoded, the rest aren't even buffered
+    addresses = [1, 3]
+    for max_chunk in [1, 2, 7, 100, len(data)]:
+        decoder = FrameDecoder(addresses=addresses)
+        got = []
+        pos = 0
+        while pos < len(data):
+            chunk_length = random.randint(1, max_chunk)
+            got += list(decoder.feed(data[pos:pos+chunk_length]))
+            pos += chunk_length
+            if decoder.skipping:
+                assert len(decoder.buffer) == 0
+        assert [(src, dst, list(frame)) for (src, dst, frame) in got] == [frame for frame in frames if frame[1] in addresses]
+        assert decoder.num_skipped >= len([frame for frame in frames if frame[1] not in addresses])
+        assert len(decoder.buffer) == 0
     
-    
+def encode_frame_test():
+    for name in crc.checksum_names():
+        checksum = crc.get_checksum(name)
+        for length in [1, 2, 16, 240, 253, 254, 255, 600]:
+            frame = bytes([random.randint(0,255) if random.random() < 0.9 else 0 for i in range(length)])
+            # The frame built the long way round
+            unencoded = bytes([5]) + frame
+            unencoded += checksum.to_bytes(checksum.calc(unencoded))
+            exp = bytes([7, 7]) + cobs.encode(unencoded) + bytes([0])
+            encoded = encode_frame(5, 6, frame, checksum)
+            assert encoded == exp
+            assert len(encoded) <= max_frame_length(length, checksum)
+            assert encode_frame(5, 6, list(frame), checksum) == exp
+
+def encode_frames_test():
+    frames = [[random.randint(0,255) for i in range(random.randint(1, 240))] for f in range(20)]
+    (encoded, offsets) = encode_frames(3, 4, frames)
+    assert encoded == b''.join([encode_frame(3, 4, frame) for frame in frames])
+    decoder = FrameDecoder()
+    for i in range(len(frames)):
+        [(src, dst, frame)] = list(decoder.feed(encoded[offsets[i]:offsets[i+1]]))
+        assert (src, dst, list(frame)) == (3, 4, frames[i])
+
+def ack_frame_test():
+    buffer = SlidingWindowByteBuffer(10**6, 10, 0)
+    # Enough frames to the same destination that the ids wrap
+    buffer.add_frames(0, 1, [i % 256 for i in range(300)], [[i % 256, 1] for i in range(300)])
+    buffer.add_frames(0, 2, [0, 1], [[0], [1]])
+    # Acks for frames that aren't queued do nothing
+    buffer.ack_frame(3, 0)
+    buffer.ack_frame(2, 5)
+    assert buffer.num_frames() == 302
+    # Cumulative ack takes the oldest matching frame
+    buffer.ack_frame(1, 9)
+    assert buffer.num_frames() == 292
+    assert buffer.frames[0][0] == 10
+    # Now id 5 is 251 frames on, which can't have been sent - it's a stale ack from before the ids wrapped
+    buffer.ack_frame(1, 5)
+    assert buffer.num_frames() == 292
+    for i in range(28):
+        buffer.ack_frame(1, (19 + i * 10) % 256)
+    buffer.ack_frame(1, 39)
+    assert buffer.num_frames() == 6
+    # Stops at frames to another destination
+    buffer.ack_frame(2, 1)
+    assert buffer.num_frames() == 6
+    buffer.ack_frame(1, 43)
+    assert buffer.num_frames() == 2
+    buffer.ack_frame(2, 1)
+    assert buffer.num_frames() == 0
+    assert buffer.num_bytes == 0
+    assert len(buffer.positions) == 0
+
 
 if __name__ == "__main__":
-    tests = [basic_test]
+    tests = [basic_test, frame_decoder_test, encode_frame_test, encode_frames_test, ack_frame_test, checksum_negotiation_test,
+        checksum_strength_test, short_frames_test, large_quantum_test, tx_memory_test, disconnected_peer_test,
+        selective_repeat_test, sack_frames_test,
+        rtt_test, flow_control_test, large_frame_test, ring_buffer_test, tx_backpressure_test,
+        ack_coalescing_test, aggregate_test, sequence_bytes_test, submit_buffers_test,
+        receive_delivery_test, address_filter_test]
     tests_passed = 0
     for test in tests:
         try: